@@ -0,0 +1,184 @@
+"""
+
+benchmark_cs_to_stars.py
+
+Times each phase of cs_to_stars (wall time, CPU time, peak memory and throughput) on synthetic cryosparc particle files and records the results as JSON.
+
+Synthetic cryosparc 3.x (picked particles) and 4.x (extracted particles) files are generated with either the usual
+cryosparc field names or anonymous field names (to exercise the positional fallback), with micrographs in sorted or
+shuffled order, together with a matching RELION 3.1+ micrographs_ctf.star file.
+
+
+"""
+
+import os
+import time
+import json
+import shutil
+import platform
+import tempfile
+import argparse
+import numpy as np
+from numpy.lib.format import open_memmap
+
+import cs_to_stars
+
+
+# Field layouts of the synthetic cs files
+LAYOUTS = {
+	"v3": [("uid", "<u8"), ("location/micrograph_uid", "<u8"), ("location/exp_group_id", "<u4"),
+		("location/micrograph_path", "S160"), ("location/micrograph_shape", "<u4", (2,)),
+		("location/center_x_frac", "<f4"), ("location/center_y_frac", "<f4"), ("pick_stats/ncc_score", "<f4"),
+		("pick_stats/power", "<f4"), ("pick_stats/template_idx", "<u4"), ("pick_stats/angle_rad", "<f4")],
+	"v4": [("uid", "<u8"), ("blob/path", "S64"), ("blob/idx", "<u4"), ("blob/shape", "<u4", (2,)),
+		("blob/psize_A", "<f4"), ("blob/sign", "<f4"), ("blob/import_sig", "<u8"), ("ctf/type", "S8"),
+		("ctf/exp_group_id", "<u4"), ("ctf/accel_kv", "<f4"), ("ctf/cs_mm", "<f4"), ("ctf/amp_contrast", "<f4"),
+		("ctf/df1_A", "<f4"), ("ctf/df2_A", "<f4"), ("ctf/df_angle_rad", "<f4"), ("ctf/phase_shift_rad", "<f4"),
+		("location/micrograph_uid", "<u8"), ("location/exp_group_id", "<u4"), ("location/micrograph_path", "S160"),
+		("location/micrograph_shape", "<u4", (2,)), ("location/micrograph_psize_A", "<f4"),
+		("location/center_x_frac", "<f4"), ("location/center_y_frac", "<f4"), ("alignments2D/split", "<u4"),
+		("alignments2D/shift", "<f4", (2,)), ("alignments2D/pose", "<f4"), ("alignments2D/class", "<u4")],
+}
+# Number of particles generated per chunk when writing the synthetic cs files
+GEN_CHUNK = 1000000
+
+
+def main(args):
+	if args.workdir == None:
+		workdir = tempfile.mkdtemp(prefix="cs_to_stars_bench_")
+	else:
+		workdir = args.workdir
+		if os.path.isdir(workdir) == False:
+			os.makedirs(workdir)
+
+	results = []
+	for particles in args.particles:
+		micrographs = max(1, particles // args.per_micrograph)
+		star_path = os.path.join(workdir, "micrographs_ctf_"+str(micrographs)+".star")
+		if os.path.isfile(star_path) == False:
+			write_star(star_path, micrographs)
+		for layout in args.layouts:
+			for named in args.naming:
+				for order in args.orders:
+					cs_path = os.path.join(workdir, "_".join([layout, named, order, str(particles)])+".cs")
+					if os.path.isfile(cs_path) == False:
+						print("Generating "+cs_path+"...")
+						write_cs(cs_path, layout, named == "named", order == "shuffled", particles, micrographs)
+					print("Benchmarking "+layout+" / "+named+" / "+order+" / "+cs_to_stars.clean_large_numbers(particles)+" particles...")
+					phases = run_phases(cs_path, star_path, os.path.join(workdir, "Raw_data"), args.jobs, os.path.join(workdir, "cache"), args.no_cache == False)
+					results.append({"layout": layout, "naming": named, "order": order, "particles": particles, "micrographs": micrographs, "phases": phases})
+					for phase in phases:
+						print("\t"+phase["phase"].ljust(16)+str(round(phase["wall_seconds"], 3))+" s")
+					if args.keep == False:
+						os.remove(cs_path)
+
+	report = {"environment": environment(), "results": results}
+	g = open(args.out, "w")
+	json.dump(report, g, indent=1)
+	g.close()
+	print("Results written to "+args.out)
+
+	if (args.keep == False) and (args.workdir == None):
+		shutil.rmtree(workdir)
+
+
+def run_phases(cs_path, star_path, out_dir, jobs=1, cache_dir=None, use_cache=True):
+	"""
+	Runs a whole conversion through cs_to_stars.convert, as the command line does, and returns the
+	cs_to_stars.PhaseProfiler report of each phase.
+
+	"""
+	profiler = cs_to_stars.PhaseProfiler()
+	if os.path.isdir(out_dir):
+		shutil.rmtree(out_dir)
+	cs_to_stars.convert(cs_path, star_path, out_dir, overwrite=True, jobs=jobs, cache_dir=cache_dir, use_cache=use_cache, profiler=profiler)
+	shutil.rmtree(out_dir)
+	return profiler.report()["phases"]
+
+
+def write_cs(cs_path, layout, named, shuffled, particles, micrographs, seed=0):
+	"""
+	Writes a synthetic cs file in chunks through a memory-mapped npy file, so that memory use stays bounded.
+
+	"""
+	dtype = np.dtype(LAYOUTS[layout])
+	if named == False:
+		dtype.names = tuple(["f"+str(i) for i in range(0, len(dtype.names))])
+	names = dtype.names
+	fields = [field[0] for field in LAYOUTS[layout]]
+	paths = np.array([micrograph_path(i) for i in range(0, micrographs)], dtype="S160")
+	rng = np.random.RandomState(seed)
+
+	out = open_memmap(cs_path, mode="w+", dtype=dtype, shape=(particles,))
+	for begin in range(0, particles, GEN_CHUNK):
+		end = min(begin+GEN_CHUNK, particles)
+		chunk = np.zeros(end-begin, dtype=dtype)
+		if shuffled == True:
+			mcg = rng.randint(0, micrographs, end-begin)
+		else:
+			mcg = (np.arange(begin, end, dtype=np.int64)*micrographs) // particles
+		chunk[names[fields.index("uid")]] = rng.randint(0, 2**62, end-begin)
+		chunk[names[fields.index("location/micrograph_uid")]] = mcg
+		chunk[names[fields.index("location/micrograph_path")]] = paths[mcg]
+		chunk[names[fields.index("location/micrograph_shape")]] = (4092, 5760)
+		chunk[names[fields.index("location/center_x_frac")]] = rng.random_sample(end-begin)
+		chunk[names[fields.index("location/center_y_frac")]] = rng.random_sample(end-begin)
+		if layout == "v3":
+			chunk[names[fields.index("pick_stats/ncc_score")]] = rng.random_sample(end-begin)
+			chunk[names[fields.index("pick_stats/power")]] = 100+1000*rng.random_sample(end-begin)
+			chunk[names[fields.index("pick_stats/angle_rad")]] = 6.28*rng.random_sample(end-begin)
+		else:
+			chunk[names[fields.index("blob/path")]] = b"J12/extract/particles.mrc"
+			chunk[names[fields.index("blob/idx")]] = np.arange(begin, end) % 1000
+			chunk[names[fields.index("blob/shape")]] = 256
+			chunk[names[fields.index("blob/psize_A")]] = 1.06
+			chunk[names[fields.index("ctf/df1_A")]] = 15000+5000*rng.random_sample(end-begin)
+			chunk[names[fields.index("ctf/df2_A")]] = 15000+5000*rng.random_sample(end-begin)
+			chunk[names[fields.index("location/micrograph_psize_A")]] = 0.83
+			chunk[names[fields.index("alignments2D/pose")]] = 6.28*rng.random_sample(end-begin)
+			chunk[names[fields.index("alignments2D/class")]] = rng.randint(0, 100, end-begin)
+		out[begin:end] = chunk
+	out.flush()
+	del out
+
+
+def write_star(star_path, micrographs):
+	"""
+	Writes a RELION 3.1+ style micrographs_ctf.star file listing the synthetic micrographs.
+
+	"""
+	g = open(star_path, "w")
+	g.write("\n# version 30001\n\ndata_optics\n\nloop_ \n_rlnOpticsGroupName #1 \n_rlnOpticsGroup #2 \n_rlnMicrographPixelSize #3 \nopticsGroup1            1     0.830000 \n \n")
+	g.write("\n# version 30001\n\ndata_micrographs\n\nloop_ \n_rlnMicrographName #1 \n_rlnOpticsGroup #2 \n_rlnCtfImage #3 \n_rlnDefocusU #4 \n_rlnDefocusV #5 \n")
+	for i in range(0, micrographs):
+		name = micrograph_name(i)
+		g.write("MotionCorr/job002/Movies/"+name+".mrc            1 CtfFind/job003/Movies/"+name+".ctf:mrc 15234.500000 14987.250000 \n")
+	g.write(" \n")
+	g.close()
+
+
+def micrograph_name(i):
+	return "FoilHole_"+str(1000000+i)+"_Data_"+str(2000000+i // 7)+"_"+str(3000000+i % 7)+"_20240101_"+str(100000+i)+"_fractions"
+
+
+def micrograph_path(i):
+	return "J2/motioncorrected/"+str(100000000000000+i)+"_"+micrograph_name(i)+"_patch_aligned_doseweighted.mrc"
+
+
+def environment():
+	return {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(), "cpu_count": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--particles", help="particle counts to benchmark (default: 100000 1000000)", type=int, nargs="+", default=[100000, 1000000])
+	parser.add_argument("--per_micrograph", help="average number of particles per micrograph (default: 700)", type=int, default=700)
+	parser.add_argument("--layouts", help="cryosparc file layouts to generate (default: v3 v4)", nargs="+", choices=["v3", "v4"], default=["v3", "v4"])
+	parser.add_argument("--naming", help="named cryosparc fields and/or anonymous fields for the positional fallback (default: named positional)", nargs="+", choices=["named", "positional"], default=["named", "positional"])
+	parser.add_argument("--orders", help="micrograph order of the particles (default: sorted shuffled)", nargs="+", choices=["sorted", "shuffled"], default=["sorted", "shuffled"])
+	parser.add_argument("--jobs", help="number of threads writing star files (default: 1)", type=int, default=1)
+	parser.add_argument("--no_cache", help="re-parse the star file for every run instead of using the micrograph name cache (kept in the workdir)", action="store_true")
+	parser.add_argument("--workdir", help="folder for the synthetic files (default: a temporary folder)")
+	parser.add_argument("--keep", help="keep the synthetic files after benchmarking", action="store_true")
+	parser.add_argument("--out", help="JSON results file (default: benchmark_cs_to_stars.json)", default="benchmark_cs_to_stars.json")
+	main(parser.parse_args())
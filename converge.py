@@ -7,135 +7,552 @@ Script for tracking convergence between classes in relion.
 """
 
 
-import sys
+import os
+import argparse
 from os.path import isfile, join
 import time
-import matplotlib as mpl
-mpl.use("Agg")
-mpl.rc('figure', max_open_warning = 0)
-import matplotlib.pyplot as plt
-
-
+import json
+import select
+import struct
+import threading
+import numpy as np
+
+
+# Seconds a star file's size must stay unchanged before it counts as completely written
+STABLE_SECONDS = 2.0
+# Shortest and longest interval between checks when inotify is not available
+POLL_MIN = 0.25
+POLL_MAX = 5.0
+# inotify event masks
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+
+
+
+def main(totalIterations, checkpoint="converge_checkpoint", restart=False, plots="all"):
+	# Pick up from the last checkpointed iteration, or set a counter of iterations and an empty class history
+	history = None
+	if restart == False:
+		history = resume_history(checkpoint, totalIterations)
+	if history != None:
+		iteration = history.iterations+1
+		counts_dict = class_counter(history)
+		print("Resuming after iteration "+str(history.iterations)+" from the checkpoint in "+checkpoint)
+	else:
+		iteration = 1
+		history = ClassHistory(totalIterations)
 
-def main(totalIterations):
-	# Set a counter of iterations and an empty dictionary
-	iteration = 1
-	newDict = {}
+		# Create a logfile
+		g = open("converge.log", "w")
+		g.write(" ")
+		g.close()
+		start_transitions()
 
-	# Create a logfile
-	g = open("converge.log", "w")
-	g.write(" ")
-	g.close()
+	# Watch the job folder for new star files, and draw the plots in the background
+	watcher = DirectoryWatcher(".")
+	plotter = PlotWorker(plots)
 
 	# Set up a loop that loads each data file as it appears
 	while iteration <= totalIterations:
 		current_star = "run_it"+threepad(str(iteration), 3)+"_data.star"
-		if isfile("run_it"+threepad(str(iteration+1), 3)+"_data.star") == False:
-			time.sleep(20)
+		# Wait until relion has finished writing the star file
+		wait_for_star(current_star, "run_it"+threepad(str(iteration+1), 3)+"_data.star", watcher)
 
 		if isfile(current_star):
-			# Pause for 15s to allow relion to actually write the star file.
-			if isfile("run_it"+threepad(str(iteration+1), 3)+"_data.star") == False:
-				time.sleep(15)
-
-			# Read the current star file and populate the dictionary
-			newDict = parse_star(current_star, newDict)
+			# Read the current star file and add its class assignments to the history
+			names, classes = parse_star(current_star)
+			history.add_iteration(names, classes)
 			
 			# Calculate the number of particles that switched classes in the last iteration
-			change_counter = 0
-			total_counter = 0
+			total_counter = len(history.ids)
 			if iteration > 1:
-				for item in newDict:
-					total_counter += 1
-					if newDict[item][iteration-1] != newDict[item][iteration-2]:
-						change_counter += 1
+				transitions = history.transitions()
+				change_counter = int(transitions.sum()-transitions.trace())
+				write_transitions(transitions, iteration)
 				g = open("converge.log", "a")
 				g.write("Iteration: "+str(iteration)+"\n")
 				g.write(str(change_counter)+" of "+str(total_counter)+" particles were re-assigned to new classes.\nThis is "+str(round(100*float(change_counter)/float(total_counter), 1))+" percent of the input pool.\n\n")
 				g.close()
 				# Count the number of particles in each class
-				counts_dict = class_counter(counts_dict, newDict)
+				counts_dict = class_counter(history)
 			else:
-				for item in newDict:
-					total_counter += 1
 				g = open("converge.log", "a")
 				g.write("Iteration: "+str(iteration)+"\n")
 				g.write("Loaded data for "+str(total_counter)+" particles.\n\n")
 				g.close()
 				# Count the number of particles in each class
-				counts_dict = class_counter({}, newDict)
+				counts_dict = class_counter(history)
 			
-			# Create a plot of the class populations over time
-			x = range(1, iteration+1)
-			fig, ax = plt.subplots()
-			ax.set(xlabel="Iteration", ylabel="Particles in Class")
-			ax.grid()
-			for item in counts_dict:
-				y = counts_dict[item]
-				ax.plot(x, y, label=item)
-			ax.legend()
-			fig.savefig("converge_"+no_ext(current_star)+".png")
-			plt.clf()
+			# Queue a plot of the class populations over time
+			plotter.submit(counts_dict, "converge_"+no_ext(current_star)+".png")
+
+			# Checkpoint the class history, so that a restart can resume from here
+			history.save(checkpoint, current_star)
 
 			#Increment the iteration counter 
 			iteration += 1
 
+	watcher.close()
+	plotter.close()
 
-def class_counter(countDict, inDict):
-	# Is the countDict empty?  Is so, populate it with empty lists.
-	if countDict == {}:
-		newDict = {}
-		for item in inDict:
-			if inDict[item][-1] not in newDict.keys():
-				newDict[inDict[item][-1]] = []
-	else:
-		newDict = countDict.copy()
-
-	# Add a zero count to each item in newDict
-	for item in newDict:
-		newDict[item].append(0)
-
-	# Count the current class populations
-	for item in inDict:
-		newDict[inDict[item][-1]][-1] += 1
-
-	return newDict
-
-def parse_star(inStar, prevDict):
-	# Open file
-	f = open(inStar, "r")
-	lines = f.readlines()
-
-	# Find the position of "_rlnClassNumber" and "_rlnImageName" in the star file loop definition
-	image_found = False
-	class_found = False
-	for j in range(0, len(lines)):
-		if "_rlnImageName" in lines[j]:
-			if image_found == False:
-				image_parse_pos = int(lines[j][lines[j].find("#")+1:])-1
-				image_index = j
-				image_found = True
-		if "_rlnClassNumber" in lines[j]:
-			if class_found == False:
-				class_parse_pos = int(lines[j][lines[j].find("#")+1:])-1
-				class_index = j
-				class_found = True
-		if (image_found == True) and (class_found == True):
-			break
-
-	# Is the dictionary empty?  If so, populate it with the micrograh names.
-	if prevDict == {}:
-		for i in range(max(image_index, class_index)+1, len(lines)):
-			if (lines[i][0] != "_") and len(lines[i]) > 20:
-				prevDict[lines[i].split()[image_parse_pos]] = []
-
-	# Isolate the features from each line of the star file
-	for i in range(max(image_index, class_index)+1, len(lines)):
-			if (lines[i][0] != "_") and len(lines[i]) > 20:
-				this_class = lines[i].split()[class_parse_pos]
-				prevDict[lines[i].split()[image_parse_pos]].append(this_class)
-
-	return prevDict
+
+class DirectoryWatcher(object):
+	"""
+	Waits for files in a folder to change, using inotify where available (through a small ctypes binding) and
+	polling with a backoff from POLL_MIN to POLL_MAX seconds otherwise.
+
+	"""
+	def __init__(self, folder="."):
+		self.folder = folder
+		self.fd = None
+		self.written = set()
+		self.interval = POLL_MIN
+		self.folder_mtime = None
+		try:
+			import ctypes
+			import ctypes.util
+			libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+			fd = libc.inotify_init()
+			if fd >= 0:
+				if libc.inotify_add_watch(fd, folder.encode(), IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) >= 0:
+					self.fd = fd
+				else:
+					os.close(fd)
+		except (OSError, AttributeError):
+			self.fd = None
+
+	def wait(self, timeout):
+		"""
+		Returns after something changes in the folder, or after at most timeout seconds.
+
+		"""
+		if self.fd != None:
+			ready = select.select([self.fd], [], [], timeout)[0]
+			if len(ready) > 0:
+				self.read_events()
+			return
+		# Poll, backing off while the folder stays unchanged
+		time.sleep(min(timeout, self.interval))
+		folder_mtime = os.stat(self.folder).st_mtime
+		if folder_mtime != self.folder_mtime:
+			self.folder_mtime = folder_mtime
+			self.interval = POLL_MIN
+		else:
+			self.interval = min(2*self.interval, POLL_MAX)
+
+	def read_events(self):
+		data = os.read(self.fd, 65536)
+		pos = 0
+		while pos+16 <= len(data):
+			wd, mask, cookie, length = struct.unpack("iIII", data[pos:pos+16])
+			name = data[pos+16:pos+16+length].rstrip(b"\0").decode("utf-8", "replace")
+			if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+				self.written.add(name)
+			elif mask & IN_MODIFY:
+				self.written.discard(name)
+			pos += 16+length
+
+	def finished(self, name):
+		"""
+		Returns True if a file has been closed after writing (or moved into the folder) and not modified since.
+		Always False when polling.
+
+		"""
+		return name in self.written
+
+	def close(self):
+		if self.fd != None:
+			os.close(self.fd)
+			self.fd = None
+
+
+def wait_for_star(current_star, next_star, watcher):
+	"""
+	Blocks until relion has finished writing current_star.  It counts as complete as soon as it has been closed after
+	writing, once the next iteration's star file exists, or once its size and modification time have stayed the same
+	for STABLE_SECONDS.  (The iteration's _optimiser.star file is no sign of completeness: relion writes it before the
+	data star file.)
+
+	"""
+	last_stat = None
+	stable_since = time.time()
+	while True:
+		if isfile(next_star):
+			return
+		if isfile(current_star):
+			if watcher.finished(current_star):
+				return
+			stat = os.stat(current_star)
+			if (stat.st_size, stat.st_mtime) != last_stat:
+				last_stat = (stat.st_size, stat.st_mtime)
+				stable_since = time.time()
+			elif (stat.st_size > 0) and (time.time()-stable_since >= STABLE_SECONDS):
+				return
+		watcher.wait(POLL_MIN)
+
+
+class ClassHistory(object):
+	"""
+	Class assignments of every particle over the iterations.  Particle names are interned once to row numbers, and
+	the class numbers are kept in a growable int16 matrix of particles x iterations (0 where a particle was not
+	present), with the class populations of each iteration counted by np.bincount.  iteration_numbers holds the
+	relion iteration number of each column, since a series may skip iterations.
+
+	"""
+	def __init__(self, iterations=1):
+		self.ids = {}
+		self.names = None
+		self.rows = None
+		self.assignments = np.zeros((0, max(iterations, 1)), dtype=np.int16)
+		self.iterations = 0
+		self.iteration_numbers = []
+		self.populations = []
+		self.class_order = []
+		self.saved_particles = 0
+		self.saved_iterations = 0
+
+	def add_iteration(self, names, classes, number=None):
+		"""
+		Records the classes of one iteration, given the particle names and class numbers of its star file, and its
+		relion iteration number (by default, the number of iterations recorded so far plus one).
+
+		"""
+		# Particles are normally listed in the same order every iteration, so the rows only need looking up once
+		if (self.names == None) or (len(names) != len(self.names)) or (names != self.names):
+			rows = np.empty(len(names), dtype=np.int64)
+			for i in range(0, len(names)):
+				rows[i] = self.ids.setdefault(names[i], len(self.ids))
+			self.names = names
+			self.rows = rows
+		if self.iterations == self.assignments.shape[1]:
+			self.assignments = np.concatenate([self.assignments, np.zeros(self.assignments.shape, dtype=np.int16)], axis=1)
+		if len(self.ids) > self.assignments.shape[0]:
+			grown = np.zeros((max(len(self.ids), 2*self.assignments.shape[0]), self.assignments.shape[1]), dtype=np.int16)
+			grown[0:self.assignments.shape[0]] = self.assignments
+			self.assignments = grown
+		self.assignments[self.rows, self.iterations] = classes
+		self.iterations += 1
+		if number == None:
+			number = self.iterations
+		self.iteration_numbers.append(number)
+
+		# Count the class populations, keeping the classes in order of first appearance
+		self.populations.append(np.bincount(classes, minlength=1))
+		present, first_seen = np.unique(classes, return_index=True)
+		for item in present[np.argsort(first_seen, kind="stable")].tolist():
+			if item not in self.class_order:
+				self.class_order.append(item)
+
+	def column(self, iteration):
+		"""
+		Returns the class of every particle in an iteration (counting from 1).
+
+		"""
+		return self.assignments[0:len(self.ids), iteration-1]
+
+	def transitions(self):
+		"""
+		Returns the class transition matrix of the last iteration, counted by a single np.bincount: entry [a, b] is
+		the number of particles that moved from class a to class b, with class 0 standing for particles not present
+		in an iteration.  Particles whose class changed are the ones off the diagonal.
+
+		"""
+		previous = self.column(self.iterations-1).astype(np.int64)
+		current = self.column(self.iterations).astype(np.int64)
+		k = max(int(previous.max(initial=0)), int(current.max(initial=0)))+1
+		return np.bincount(previous*k+current, minlength=k*k).reshape(k, k)
+
+	def save(self, folder, last_star):
+		"""
+		Checkpoints the history into folder: the particle names (rewritten only when new particles were added), one
+		int16 class column per iteration not saved yet, and a small state file.  The state file is replaced last, so
+		an interrupted save leaves the previous checkpoint usable.
+
+		"""
+		if os.path.isdir(folder) == False:
+			os.makedirs(folder)
+		if len(self.ids) != self.saved_particles:
+			write_array(join(folder, "names.npy"), np.array(list(self.ids.keys()), dtype=bytes))
+			self.saved_particles = len(self.ids)
+		for i in range(self.saved_iterations, self.iterations):
+			write_array(join(folder, "it"+threepad(str(i+1), 3)+".npy"), self.assignments[0:len(self.ids), i])
+		self.saved_iterations = self.iterations
+
+		state = {"iterations": self.iterations, "iteration_numbers": self.iteration_numbers, "particles": len(self.ids), "class_order": self.class_order, "last_star": star_signature(last_star)}
+		g = open(join(folder, "state.json.tmp"), "w")
+		json.dump(state, g)
+		g.close()
+		os.replace(join(folder, "state.json.tmp"), join(folder, "state.json"))
+
+	@classmethod
+	def load(cls, folder, iterations=1):
+		"""
+		Rebuilds a history from a checkpoint folder.  Returns the history and the star file signature of its last
+		iteration, or None and None if there is no usable checkpoint.
+
+		"""
+		try:
+			g = open(join(folder, "state.json"), "r")
+			state = json.load(g)
+			g.close()
+			names = np.load(join(folder, "names.npy"))[0:state["particles"]].tolist()
+			columns = [np.load(join(folder, "it"+threepad(str(i+1), 3)+".npy")) for i in range(0, state["iterations"])]
+		except (IOError, OSError, ValueError, KeyError):
+			return None, None
+		if len(names) < state["particles"]:
+			return None, None
+
+		history = cls(max(iterations, state["iterations"]))
+		history.ids = dict([(names[i], i) for i in range(0, len(names))])
+		history.assignments = np.zeros((len(names), history.assignments.shape[1]), dtype=np.int16)
+		for i in range(0, len(columns)):
+			history.assignments[0:len(columns[i]), i] = columns[i]
+			# Particles not present in an iteration (class 0) were not counted when it was added
+			history.populations.append(np.bincount(columns[i][columns[i] > 0], minlength=1))
+		history.iterations = len(columns)
+		history.iteration_numbers = state.get("iteration_numbers", list(range(1, len(columns)+1)))
+		history.class_order = state["class_order"]
+		history.saved_particles = len(names)
+		history.saved_iterations = len(columns)
+		return history, state["last_star"]
+
+
+def start_transitions(folder="."):
+	"""
+	Creates the transition logs of a job folder: converge_classes.csv with the populations, inflow, outflow and
+	stability of every class, and converge_transitions.csv with the number of particles moving between each pair of
+	classes.
+
+	"""
+	g = open(join(folder, "converge_classes.csv"), "w")
+	g.write("iteration,class,previous,current,stayed,inflow,outflow,stability\n")
+	g.close()
+	g = open(join(folder, "converge_transitions.csv"), "w")
+	g.write("iteration,from_class,to_class,particles\n")
+	g.close()
+
+
+def write_transitions(transitions, iteration, folder="."):
+	"""
+	Appends one iteration of a ClassHistory.transitions matrix to the transition logs.  Stability is the fraction
+	of a class that stayed in it; only pairs of classes that actually exchanged particles are listed, with class 0
+	standing for particles that were added or left out.
+
+	"""
+	if isfile(join(folder, "converge_classes.csv")) == False:
+		start_transitions(folder)
+	stayed = np.diag(transitions)
+	previous = transitions.sum(axis=1)
+	current = transitions.sum(axis=0)
+	stability = stayed/np.maximum(previous, 1).astype(np.float64)
+	lines = []
+	for item in np.flatnonzero((previous > 0) | (current > 0)).tolist():
+		if item > 0:
+			lines.append(",".join([str(iteration), str(item), str(previous[item]), str(current[item]), str(stayed[item]), str(current[item]-stayed[item]), str(previous[item]-stayed[item]), "%.4f" % stability[item]])+"\n")
+	g = open(join(folder, "converge_classes.csv"), "a")
+	g.writelines(lines)
+	g.close()
+
+	moved = transitions.copy()
+	np.fill_diagonal(moved, 0)
+	sources, targets = np.nonzero(moved)
+	lines = [str(iteration)+","+str(sources[i])+","+str(targets[i])+","+str(moved[sources[i], targets[i]])+"\n" for i in range(0, len(sources))]
+	g = open(join(folder, "converge_transitions.csv"), "a")
+	g.writelines(lines)
+	g.close()
+
+
+def write_array(path, array):
+	"""
+	Saves an np array as a .npy file, through a temporary file so that a partial file never replaces a good one.
+
+	"""
+	g = open(path+".tmp", "wb")
+	np.save(g, array)
+	g.close()
+	os.replace(path+".tmp", path)
+
+
+def star_signature(inStar):
+	"""
+	Returns the file name (without its folder), size and modification time of a star file, to recognize it when
+	resuming from a checkpoint.
+
+	"""
+	stat = os.stat(inStar)
+	return [os.path.basename(inStar), stat.st_size, stat.st_mtime]
+
+
+def resume_history(checkpoint, totalIterations, folder="."):
+	"""
+	Loads the class history from a checkpoint folder, if there is one and the star file of its last iteration is
+	unchanged in the job folder.  Returns the history, or None to start from iteration 1.
+
+	"""
+	history, last_star = ClassHistory.load(checkpoint, totalIterations)
+	if history == None:
+		return None
+	star_path = join(folder, last_star[0])
+	if (isfile(star_path) == False) or (star_signature(star_path) != last_star):
+		print("The checkpoint in "+checkpoint+" does not match "+star_path+" any more, starting from iteration 1.")
+		return None
+	return history
+
+
+class PlotWorker(object):
+	"""
+	Renders the class population plots on a background thread, so that reading the next iteration does not wait
+	for matplotlib.  One figure is created (importing matplotlib only then) and redrawn for every plot.  mode is
+	"all" for a png per iteration, "latest" for a single converge_latest.png per folder that is overwritten (skipping
+	plots that were superseded before they could be drawn), or "none" for no plots.
+
+	"""
+	def __init__(self, mode="all"):
+		self.mode = mode
+		self.pending = []
+		self.done = False
+		self.condition = threading.Condition()
+		self.thread = None
+		if mode != "none":
+			self.thread = threading.Thread(target=self.run)
+			self.thread.daemon = True
+			self.thread.start()
+
+	def submit(self, counts_dict, file_name, iterations=None):
+		"""
+		Queues a plot of the class populations in counts_dict (class -> population in each iteration), against the
+		given iteration numbers (by default 1, 2, 3...).
+
+		"""
+		if self.thread == None:
+			return
+		if self.mode == "latest":
+			file_name = join(os.path.dirname(file_name), "converge_latest.png")
+		snapshot = dict([(item, list(counts_dict[item])) for item in counts_dict])
+		if iterations != None:
+			iterations = list(iterations)
+		with self.condition:
+			if self.mode == "latest":
+				self.pending = [request for request in self.pending if request[1] != file_name]
+			self.pending.append((snapshot, file_name, iterations))
+			self.condition.notify()
+
+	def run(self):
+		from matplotlib.figure import Figure
+		from matplotlib.backends.backend_agg import FigureCanvasAgg
+		fig = Figure()
+		FigureCanvasAgg(fig)
+		ax = fig.add_subplot(111)
+		while True:
+			with self.condition:
+				while (len(self.pending) == 0) and (self.done == False):
+					self.condition.wait()
+				if len(self.pending) == 0:
+					break
+				counts_dict, file_name, iterations = self.pending.pop(0)
+			try:
+				# Create a plot of the class populations over time
+				ax.clear()
+				ax.set(xlabel="Iteration", ylabel="Particles in Class")
+				ax.grid()
+				for item in counts_dict:
+					y = counts_dict[item]
+					if iterations == None:
+						ax.plot(range(1, len(y)+1), y, label=item)
+					else:
+						ax.plot(iterations, y, label=item)
+				ax.legend()
+				fig.savefig(file_name+".tmp", format="png")
+				os.replace(file_name+".tmp", file_name)
+			except Exception as e:
+				print("WARNING: Could not write the plot "+file_name+": "+str(e))
+		fig.clear()
+
+	def close(self):
+		"""
+		Waits for the queued plots to be written and releases the figure.
+
+		"""
+		if self.thread == None:
+			return
+		with self.condition:
+			self.done = True
+			self.condition.notify()
+		self.thread.join()
+
+
+def class_counter(history):
+	"""
+	Returns a dictionary of class number -> population in each iteration, in order of first appearance.
+
+	"""
+	countDict = {}
+	for item in history.class_order:
+		countDict[str(item)] = [int(counts[item]) if item < len(counts) else 0 for counts in history.populations]
+	return countDict
+
+
+def parse_star(inStar):
+	"""
+	Streams a relion data star file and returns the particle names (as bytes) and class numbers (as an int16 array)
+	of its data_particles block, or of the last loop holding both columns for star files without one (relion 3.0).
+	Only the _rlnImageName and _rlnClassNumber fields are split out of each row.
+
+	"""
+	names = None
+	classes = None
+	found_block = None
+	current_block = None
+	labels = {}
+	in_header = False
+
+	g = open(inStar, "rb")
+	line = next(g, b"")
+	while len(line) > 0:
+		stripped = line.strip()
+		if (len(stripped) == 0) or (stripped[0:1] == b"#"):
+			pass
+		elif stripped.startswith(b"data_"):
+			current_block = stripped.split()[0]
+			labels = {}
+			in_header = False
+		elif stripped.startswith(b"loop_"):
+			labels = {}
+			in_header = True
+		elif stripped[0:1] == b"_":
+			# Use the column number after "#" when present, otherwise the label order
+			if in_header == True:
+				parts = stripped.split()
+				if (len(parts) > 1) and (parts[1][0:1] == b"#"):
+					labels[parts[0]] = int(parts[1][1:])-1
+				else:
+					labels[parts[0]] = len(labels)
+		elif in_header == True:
+			# First row of a loop: read the whole loop if it holds both columns
+			in_header = False
+			if (b"_rlnImageName" in labels) and (b"_rlnClassNumber" in labels) and ((current_block == b"data_particles") or (found_block != b"data_particles")):
+				image_pos = labels[b"_rlnImageName"]
+				class_pos = labels[b"_rlnClassNumber"]
+				max_split = max(image_pos, class_pos)+1
+				names = []
+				classes = []
+				found_block = current_block
+				while len(line) > 0:
+					fields = line.split(None, max_split)
+					if (len(fields) < max_split) or fields[0].startswith((b"data_", b"loop_", b"_")):
+						break
+					names.append(fields[image_pos])
+					classes.append(fields[class_pos])
+					line = next(g, b"")
+				continue
+		line = next(g, b"")
+	g.close()
+
+	if names == None:
+		raise ValueError("No loop with _rlnImageName and _rlnClassNumber columns found in "+inStar)
+	return names, np.array(list(map(int, classes)), dtype=np.int16)
 
 
 def threepad(inStr, final_len):
@@ -198,9 +615,11 @@ def clean_large_numbers(inInt):
 
 
 if __name__ == "__main__":
-	if len(sys.argv) == 2:
-		print("Live output will be logged in: converge.log")
-		main(int(sys.argv[1]))
-	else:
-		print("Check usage: python converge.py numberOfIterations")
-		exit()
\ No newline at end of file
+	parser = argparse.ArgumentParser(description="Tracks the convergence of classes in a relion classification run.")
+	parser.add_argument("numberOfIterations", help="number of iterations of the relion job", type=int)
+	parser.add_argument("--checkpoint", help="folder for the checkpoint used to resume after a restart (default: converge_checkpoint)", default="converge_checkpoint")
+	parser.add_argument("--restart", help="ignore any checkpoint and start again from iteration 1", action="store_true")
+	parser.add_argument("--plots", help="write a png plot for every iteration (all), only keep an up-to-date converge_latest.png (latest), or only write the log (none) (default: all)", choices=["all", "latest", "none"], default="all")
+	args = parser.parse_args()
+	print("Live output will be logged in: converge.log")
+	main(args.numberOfIterations, args.checkpoint, args.restart, args.plots)
\ No newline at end of file
@@ -1,250 +1,127 @@
 """
 
-converge.py
+converge_continue.py
 
-Script for tracking convergence between classes in relion in a continue run.
+Script for tracking convergence between classes in relion in a continue run.  Uses the class history, star file
+reader, folder watcher and plotting of converge.py, which needs to be in the same folder.
 
 """
 
 
-import sys
-from os.path import isfile, join
-import time
-import matplotlib as mpl
-mpl.use("Agg")
-mpl.rc('figure', max_open_warning = 0)
-import matplotlib.pyplot as plt
+import argparse
+from os.path import isfile
 
+import converge
 
 
-def main(prevIterations, totalIterations):
-	# Set a counter of iterations and an empty dictionary
-	iteration = 1
-	newDict = {}
 
-	# Create a logfile
-	g = open("converge.log", "w")
-	g.write(" ")
-	g.close()
+def main(prevIterations, totalIterations, checkpoint="converge_checkpoint", restart=False, plots="all"):
+	# Pick up from the last checkpointed iteration, or set a counter of iterations and an empty class history
+	history = None
+	if restart == False:
+		history = converge.resume_history(checkpoint, totalIterations)
+	if history != None:
+		iteration = history.iterations+1
+		counts_dict = converge.class_counter(history)
+		print("Resuming after iteration "+str(history.iterations)+" from the checkpoint in "+checkpoint)
+	else:
+		iteration = 1
+		history = converge.ClassHistory(totalIterations)
+
+		# Create a logfile
+		g = open("converge.log", "w")
+		g.write(" ")
+		g.close()
+		converge.start_transitions()
+
+	# Watch the job folder for new star files, and draw the plots in the background
+	watcher = converge.DirectoryWatcher(".")
+	plotter = converge.PlotWorker(plots)
 
 	# Set up a loop that loads each data file as it appears
 	while iteration <= prevIterations:
-		current_star = "run_it"+threepad(str(iteration), 3)+"_data.star"
-		if isfile("run_it"+threepad(str(iteration+1), 3)+"_data.star") == False:
-			time.sleep(20)
+		current_star = "run_it"+converge.threepad(str(iteration), 3)+"_data.star"
+		# Wait until relion has finished writing the star file
+		converge.wait_for_star(current_star, "run_it"+converge.threepad(str(iteration+1), 3)+"_data.star", watcher)
 
 		if isfile(current_star):
-			# Pause for 15s to allow relion to actually write the star file.
-			if isfile("run_it"+threepad(str(iteration+1), 3)+"_data.star") == False:
-				time.sleep(15)
-
-			# Read the current star file and populate the dictionary
-			newDict = parse_star(current_star, newDict)
+			# Read the current star file and add its class assignments to the history
+			names, classes = converge.parse_star(current_star)
+			history.add_iteration(names, classes)
 			
 			# Calculate the number of particles that switched classes in the last iteration
-			change_counter = 0
-			total_counter = 0
+			total_counter = len(history.ids)
 			if iteration > 1:
-				for item in newDict:
-					total_counter += 1
-					if newDict[item][iteration-1] != newDict[item][iteration-2]:
-						change_counter += 1
+				transitions = history.transitions()
+				change_counter = int(transitions.sum()-transitions.trace())
+				converge.write_transitions(transitions, iteration)
 				g = open("converge.log", "a")
 				g.write("Iteration: "+str(iteration)+"\n")
 				g.write(str(change_counter)+" of "+str(total_counter)+" particles were re-assigned to new classes.\nThis is "+str(round(100*float(change_counter)/float(total_counter), 1))+" percent of the input pool.\n\n")
 				g.close()
 				# Count the number of particles in each class
-				counts_dict = class_counter(counts_dict, newDict)
+				counts_dict = converge.class_counter(history)
 			else:
-				for item in newDict:
-					total_counter += 1
 				g = open("converge.log", "a")
 				g.write("Iteration: "+str(iteration)+"\n")
 				g.write("Loaded data for "+str(total_counter)+" particles.\n\n")
 				g.close()
 				# Count the number of particles in each class
-				counts_dict = class_counter({}, newDict)
+				counts_dict = converge.class_counter(history)
 			
-			# Create a plot of the class populations over time
-			x = range(1, iteration+1)
-			fig, ax = plt.subplots()
-			ax.set(xlabel="Iteration", ylabel="Particles in Class")
-			ax.grid()
-			for item in counts_dict:
-				y = counts_dict[item]
-				ax.plot(x, y, label=item)
-			ax.legend()
-			fig.savefig("converge_"+threepad(str(iteration), 3)+".png")
-			plt.clf()
+			# Queue a plot of the class populations over time
+			plotter.submit(counts_dict, "converge_"+converge.threepad(str(iteration), 3)+".png")
+
+			# Checkpoint the class history, so that a restart can resume from here
+			history.save(checkpoint, current_star)
 
 			#Increment the iteration counter 
 			iteration += 1
 
 	# Load and process the continue iterations
 	while iteration <= totalIterations:
-		current_star = "run_ct"+str(prevIterations)+"_it"+threepad(str(iteration), 3)+"_data.star"
-		if isfile("run_ct"+str(prevIterations)+"_it"+threepad(str(iteration+1), 3)+"_data.star") == False:
-			time.sleep(20)
+		current_star = "run_ct"+str(prevIterations)+"_it"+converge.threepad(str(iteration), 3)+"_data.star"
+		# Wait until relion has finished writing the star file
+		converge.wait_for_star(current_star, "run_ct"+str(prevIterations)+"_it"+converge.threepad(str(iteration+1), 3)+"_data.star", watcher)
 
 		if isfile(current_star):
-			# Pause for 15s to allow relion to actually write the star file.
-			if isfile("run_ct"+str(prevIterations)+"_it"+threepad(str(iteration+1), 3)+"_data.star") == False:
-				time.sleep(15)
-
-			# Read the current star file and populate the dictionary
-			newDict = parse_star(current_star, newDict)
+			# Read the current star file and add its class assignments to the history
+			names, classes = converge.parse_star(current_star)
+			history.add_iteration(names, classes)
 			
 			# Calculate the number of particles that switched classes in the last iteration
-			change_counter = 0
-			total_counter = 0
+			total_counter = len(history.ids)
 			if iteration > 1:
-				for item in newDict:
-					total_counter += 1
-					if newDict[item][iteration-1] != newDict[item][iteration-2]:
-						change_counter += 1
+				transitions = history.transitions()
+				change_counter = int(transitions.sum()-transitions.trace())
+				converge.write_transitions(transitions, iteration)
 				g = open("converge.log", "a")
 				g.write("Iteration: "+str(iteration)+"\n")
 				g.write(str(change_counter)+" of "+str(total_counter)+" particles were re-assigned to new classes.\nThis is "+str(round(100*float(change_counter)/float(total_counter), 1))+" percent of the input pool.\n\n")
 				g.close()
 				# Count the number of particles in each class
-				counts_dict = class_counter(counts_dict, newDict)
+				counts_dict = converge.class_counter(history)
 			
-			# Create a plot of the class populations over time
-			x = range(1, iteration+1)
-			fig, ax = plt.subplots()
-			ax.set(xlabel="Iteration", ylabel="Particles in Class")
-			ax.grid()
-			for item in counts_dict:
-				y = counts_dict[item]
-				ax.plot(x, y, label=item)
-			ax.legend()
-			fig.savefig("converge_"+threepad(str(iteration), 3)+".png")
-			plt.clf()
+			# Queue a plot of the class populations over time
+			plotter.submit(counts_dict, "converge_"+converge.threepad(str(iteration), 3)+".png")
+
+			# Checkpoint the class history, so that a restart can resume from here
+			history.save(checkpoint, current_star)
 
 			#Increment the iteration counter 
 			iteration += 1
 
-
-def class_counter(countDict, inDict):
-	# Is the countDict empty?  Is so, populate it with empty lists.
-	if countDict == {}:
-		newDict = {}
-		for item in inDict:
-			if inDict[item][-1] not in newDict.keys():
-				newDict[inDict[item][-1]] = []
-	else:
-		newDict = countDict.copy()
-
-	# Add a zero count to each item in newDict
-	for item in newDict:
-		newDict[item].append(0)
-
-	# Count the current class populations
-	for item in inDict:
-		newDict[inDict[item][-1]][-1] += 1
-
-	return newDict
-
-def parse_star(inStar, prevDict):
-	# Open file
-	f = open(inStar, "r")
-	lines = f.readlines()
-
-	# Find the position of "_rlnClassNumber" and "_rlnImageName" in the star file loop definition
-	image_found = False
-	class_found = False
-	for j in range(0, len(lines)):
-		if "_rlnImageName" in lines[j]:
-			if image_found == False:
-				image_parse_pos = int(lines[j][lines[j].find("#")+1:])-1
-				image_index = j
-				image_found = True
-		if "_rlnClassNumber" in lines[j]:
-			if class_found == False:
-				class_parse_pos = int(lines[j][lines[j].find("#")+1:])-1
-				class_index = j
-				class_found = True
-		if (image_found == True) and (class_found == True):
-			break
-
-	# Is the dictionary empty?  If so, populate it with the micrograh names.
-	if prevDict == {}:
-		for i in range(max(image_index, class_index)+1, len(lines)):
-			if (lines[i][0] != "_") and len(lines[i]) > 20:
-				prevDict[lines[i].split()[image_parse_pos]] = []
-
-	# Isolate the features from each line of the star file
-	for i in range(max(image_index, class_index)+1, len(lines)):
-			if (lines[i][0] != "_") and len(lines[i]) > 20:
-				this_class = lines[i].split()[class_parse_pos]
-				prevDict[lines[i].split()[image_parse_pos]].append(this_class)
-
-	return prevDict
-
-
-def threepad(inStr, final_len):
-	while len(inStr) < final_len:
-		inStr = "0"+inStr
-	return inStr
-
-
-def leftpad(inStr, final_len):
-	while len(inStr) < final_len:
-		inStr = " "+inStr
-	return inStr
-
-
-def no_ext(inStr):
-	"""
-	Takes an input filename and returns a string with the file extension removed.
-
-	"""
-	prevPos = 0
-	currentPos = 0
-	while currentPos != -1:
-		prevPos = currentPos
-		currentPos = inStr.find(".", prevPos+1)
-	return inStr[0:prevPos]
-
-
-def last_slash(inStr):
-	"""
-	Returns the component of a string past the last forward slash character.
-	"""
-	prevPos = 0
-	currentPos = 0
-	while currentPos != -1:
-		prevPos = currentPos
-		currentPos = inStr.find("/", prevPos+1)
-	return inStr[prevPos+1:]
-
-
-def clean_large_numbers(inInt):
-	"""
-	Takes an integer and re-formats to string with human-readable comma-spaced numbers.
-
-	"""
-	inStr = str(inInt)
-	outStr = ""
-	
-	if len(inStr) > 3:
-		for i in range(1, len(inStr)+1):
-			outStr = inStr[-i] + outStr
-			if i % 3 == 0:
-				outStr = "," + outStr
-	else:
-		outStr = inStr
-
-	if outStr[0] == ",":
-		return outStr[1:]
-	else:
-		return outStr
+	watcher.close()
+	plotter.close()
 
 
 if __name__ == "__main__":
-	if len(sys.argv) == 3:
-		print("Live output will be logged in: converge.log")
-		main(int(sys.argv[1]), int(sys.argv[2]))
-	else:
-		print("Check usage: python converge_continue.py numberOfInitialIterations numberOfTotalIterations")
-		exit()
+	parser = argparse.ArgumentParser(description="Tracks the convergence of classes in a relion continue run.")
+	parser.add_argument("prevIterations", help="number of iterations of the run being continued", type=int)
+	parser.add_argument("totalIterations", help="total number of iterations, including the continued ones", type=int)
+	parser.add_argument("--checkpoint", help="folder for the checkpoint used to resume after a restart (default: converge_checkpoint)", default="converge_checkpoint")
+	parser.add_argument("--restart", help="ignore any checkpoint and start again from iteration 1", action="store_true")
+	parser.add_argument("--plots", help="write a png plot for every iteration (all), only keep an up-to-date converge_latest.png (latest), or only write the log (none) (default: all)", choices=["all", "latest", "none"], default="all")
+	args = parser.parse_args()
+	print("Live output will be logged in: converge.log")
+	main(args.prevIterations, args.totalIterations, args.checkpoint, args.restart, args.plots)
@@ -0,0 +1,401 @@
+"""
+
+converge_daemon.py
+
+Daemon tracking convergence between classes in many relion classification jobs at once.
+
+"""
+
+
+import sys
+import os
+import re
+import argparse
+import asyncio
+from os.path import isdir, join
+
+import converge
+
+
+# Seconds between looks for new job folders under --scan folders (and for continued jobs)
+SCAN_SECONDS = 30.0
+# Seconds between checks for a star file that is still being written
+PENDING_SECONDS = 0.5
+# Names of the files relion writes for each iteration, in a regular run (run_it025_data.star) or a continue run
+# (run_ct25_it026_data.star)
+ITERATION_FILE = re.compile(r"^run_(?:ct([0-9]+)_)?it([0-9]+)_(data|optimiser)\.star$")
+
+
+
+def main(folders, scan_folders, plots="latest", restart=False, interval=5.0):
+	loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(loop)
+	plotter = converge.PlotWorker(plots)
+	try:
+		loop.run_until_complete(watch_jobs(loop, folders, scan_folders, plotter, restart, interval))
+	except KeyboardInterrupt:
+		print("Stopping.")
+	finally:
+		plotter.close()
+		loop.close()
+
+
+async def watch_jobs(loop, folders, scan_folders, plotter, restart=False, interval=5.0):
+	"""
+	Runs one JobMonitor task per job folder.  Without scan_folders, returns once every job has reached its last
+	iteration (or failed); otherwise keeps looking for new and continued jobs every SCAN_SECONDS, and retries failed
+	jobs once their folder changes.  Jobs found by scanning that had already finished (and were never tracked) are
+	left alone, and the monitors of finished jobs are let go, so memory use follows the running jobs only.
+
+	"""
+	monitors = {}
+	tasks = {}
+	# Latest data star file of each finished job, to notice when it is continued
+	finished = {}
+	while True:
+		for folder in find_jobs(folders, scan_folders):
+			if folder in finished:
+				if latest_data_star(folder) == finished[folder]:
+					continue
+				del finished[folder]
+			if folder not in monitors:
+				if (folder not in folders) and job_done(folder) and (isdir(join(folder, "converge_checkpoint")) == False):
+					finished[folder] = latest_data_star(folder)
+					print("Skipping "+folder+", which has already finished")
+					continue
+				monitors[folder] = JobMonitor(folder, plotter, restart)
+				print("Watching "+folder)
+			if ((folder not in tasks) or tasks[folder].done()) and monitors[folder].ready():
+				tasks[folder] = loop.create_task(monitors[folder].run(loop, interval))
+
+		for folder in list(monitors.keys()):
+			if (folder in tasks) and (tasks[folder].done() == False):
+				continue
+			try:
+				done = monitors[folder].finished()
+			except (IOError, OSError):
+				done = True
+			if done == True:
+				finished[folder] = latest_data_star(folder)
+				monitors[folder].close()
+				del monitors[folder]
+				tasks.pop(folder, None)
+
+		running = [task for task in tasks.values() if task.done() == False]
+		if (len(scan_folders) == 0) and (len(running) == 0):
+			break
+		if len(running) > 0:
+			await asyncio.wait(running, timeout=SCAN_SECONDS)
+		else:
+			await asyncio.sleep(SCAN_SECONDS)
+
+	for monitor in monitors.values():
+		monitor.close()
+
+
+def find_jobs(folders, scan_folders):
+	"""
+	Returns the given job folders, plus every folder up to two levels below the scan folders (e.g. Class2D/job012)
+	holding relion iteration files.
+
+	"""
+	jobs = list(folders)
+	for scan_folder in scan_folders:
+		candidates = [scan_folder]
+		for item in sorted(os.listdir(scan_folder)):
+			if isdir(join(scan_folder, item)):
+				candidates.append(join(scan_folder, item))
+				candidates.extend([join(scan_folder, item, sub) for sub in sorted(os.listdir(join(scan_folder, item))) if isdir(join(scan_folder, item, sub))])
+		for candidate in candidates:
+			if (candidate not in jobs) and any([ITERATION_FILE.match(name) != None for name in os.listdir(candidate)]):
+				jobs.append(candidate)
+	return jobs
+
+
+def iteration_files(folder):
+	"""
+	Returns the data and optimiser star files of a job folder as dictionaries of iteration -> file name.  Iterations
+	written by a continue run (run_ctNN_itNNN) replace those of the run it continued, and the latest continue run
+	wins.
+
+	"""
+	data = {}
+	optimiser = {}
+	sources = {}
+	for name in os.listdir(folder):
+		match = ITERATION_FILE.match(name)
+		if match == None:
+			continue
+		iteration = int(match.group(2))
+		if match.group(1) == None:
+			source = -1
+		else:
+			source = int(match.group(1))
+		key = (iteration, match.group(3))
+		if (key in sources) and (sources[key] > source):
+			continue
+		sources[key] = source
+		if match.group(3) == "data":
+			data[iteration] = name
+		else:
+			optimiser[iteration] = name
+	return data, optimiser
+
+
+def latest_data_star(folder):
+	"""
+	Returns the name of the data star file of the latest iteration in a job folder, or None if there is none.
+
+	"""
+	try:
+		data = iteration_files(folder)[0]
+	except (IOError, OSError):
+		return None
+	if len(data) == 0:
+		return None
+	return data[max(data.keys())]
+
+
+def job_done(folder):
+	"""
+	Returns True if a job folder already holds the last iteration given in its latest optimiser star file.
+
+	"""
+	data, optimiser = iteration_files(folder)
+	target = target_iterations(folder, optimiser)
+	return (target != None) and (len(data) > 0) and (max(data.keys()) >= target)
+
+
+def target_iterations(folder, optimiser):
+	"""
+	Reads the total number of iterations (_rlnNumberOfIterations) from the latest optimiser star file of a job, or
+	returns None if there is none yet.
+
+	"""
+	if len(optimiser) == 0:
+		return None
+	try:
+		g = open(join(folder, optimiser[max(optimiser.keys())]), "r")
+		for line in g:
+			if line.startswith("_rlnNumberOfIterations"):
+				g.close()
+				return int(line.split()[1])
+		g.close()
+	except (IOError, OSError, ValueError, IndexError):
+		pass
+	return None
+
+
+class JobMonitor(object):
+	"""
+	Tracks the class assignments of one relion job folder, writing converge.log, the plots and a checkpoint there
+	just like converge.py.  Star files are parsed on a worker thread, so that the event loop keeps serving the
+	other jobs; the folder is watched with inotify where available.
+
+	"""
+	def __init__(self, folder, plotter, restart=False):
+		self.folder = folder
+		self.plotter = plotter
+		self.checkpoint = join(folder, "converge_checkpoint")
+		self.history = None
+		if restart == False:
+			self.history = converge.resume_history(self.checkpoint, 1, folder)
+		if self.history == None:
+			self.history = converge.ClassHistory(1)
+			g = open(join(folder, "converge.log"), "w")
+			g.write(" ")
+			g.close()
+			converge.start_transitions(folder)
+		else:
+			print(folder+": resuming after iteration "+str(self.history.iteration_numbers[-1]))
+		self.loop = None
+		self.watcher = None
+		self.changed = None
+		self.last_stat = None
+		self.stable_since = 0.0
+		self.unreadable = {}
+		self.failed_mtime = None
+
+	def last_iteration(self):
+		"""
+		Returns the relion iteration number of the last iteration processed, or 0 before the first one.
+
+		"""
+		if len(self.history.iteration_numbers) == 0:
+			return 0
+		return self.history.iteration_numbers[-1]
+
+	def finished(self):
+		"""
+		Returns True once the last iteration given in the latest optimiser star file has been processed.
+
+		"""
+		data, optimiser = iteration_files(self.folder)
+		target = target_iterations(self.folder, optimiser)
+		return (target != None) and (self.last_iteration() >= target)
+
+	def ready(self):
+		"""
+		Returns True if the job should be watched: it hasn't finished, and if it failed, its folder has changed
+		since.
+
+		"""
+		try:
+			if (self.failed_mtime != None) and (os.stat(self.folder).st_mtime == self.failed_mtime):
+				return False
+			return self.finished() == False
+		except (IOError, OSError):
+			return False
+
+	def next_iteration(self, data):
+		"""
+		Returns the first iteration in data after the last one processed, skipping star files that could not be read
+		(until they change), or None if there is none yet.  Iteration series with gaps, e.g. from jobs that only keep
+		every Nth iteration, are simply stepped through.
+
+		"""
+		for iteration in sorted(data.keys()):
+			if iteration <= self.last_iteration():
+				continue
+			if data[iteration] not in self.unreadable:
+				return iteration
+			try:
+				if self.unreadable[data[iteration]] != converge.star_signature(join(self.folder, data[iteration])):
+					del self.unreadable[data[iteration]]
+					return iteration
+			except (IOError, OSError):
+				pass
+		return None
+
+	async def run(self, loop, interval=5.0):
+		try:
+			self.failed_mtime = None
+			self.start_watching(loop)
+			while self.finished() == False:
+				data = iteration_files(self.folder)[0]
+				iteration = self.next_iteration(data)
+				if (iteration != None) and (self.complete(data, iteration) == True):
+					star_path = join(self.folder, data[iteration])
+					try:
+						names, classes = await loop.run_in_executor(None, converge.parse_star, star_path)
+					except (IOError, OSError, ValueError, IndexError) as e:
+						# Skip the star file until relion rewrites it, rather than trying to read it again and again
+						self.unreadable[data[iteration]] = converge.star_signature(star_path)
+						print("WARNING: "+self.folder+": could not read "+data[iteration]+" ("+str(e)+"); skipping it until it changes.")
+						continue
+					print(await loop.run_in_executor(None, self.process, iteration, star_path, names, classes))
+					continue
+				if iteration != None:
+					await self.wait(PENDING_SECONDS)
+				else:
+					await self.wait(interval)
+			print(self.folder+": finished after iteration "+str(self.last_iteration()))
+		except Exception as e:
+			# Give up on this job until its folder changes, instead of restarting it straight away
+			print("WARNING: "+self.folder+": stopped watching after an error ("+repr(e)+"); retrying once the folder changes.")
+			try:
+				self.failed_mtime = os.stat(self.folder).st_mtime
+			except (IOError, OSError):
+				self.failed_mtime = -1.0
+		finally:
+			self.close()
+
+	def complete(self, data, iteration):
+		"""
+		Applies the rules of converge.wait_for_star without blocking: the data star file of an iteration is complete
+		once it has been closed after writing, once a later iteration exists, or once its size and modification time
+		have stayed the same for STABLE_SECONDS.
+
+		"""
+		if iteration not in data:
+			return False
+		if max(data.keys()) > iteration:
+			return True
+		if (self.watcher != None) and self.watcher.finished(data[iteration]):
+			return True
+		stat = os.stat(join(self.folder, data[iteration]))
+		if (stat.st_size, stat.st_mtime) != self.last_stat:
+			self.last_stat = (stat.st_size, stat.st_mtime)
+			self.stable_since = self.loop.time()
+			return False
+		return (stat.st_size > 0) and (self.loop.time()-self.stable_since >= converge.STABLE_SECONDS)
+
+	def process(self, iteration, star_path, names, classes):
+		"""
+		Adds one iteration, as read from its star file by converge.parse_star, to the history, logs it, queues its
+		plot and checkpoints the history.  Returns a status line for the console.
+
+		"""
+		self.history.add_iteration(names, classes, iteration)
+		self.last_stat = None
+
+		total_counter = len(self.history.ids)
+		g = open(join(self.folder, "converge.log"), "a")
+		g.write("Iteration: "+str(iteration)+"\n")
+		if self.history.iterations > 1:
+			transitions = self.history.transitions()
+			change_counter = int(transitions.sum()-transitions.trace())
+			converge.write_transitions(transitions, iteration, self.folder)
+			g.write(str(change_counter)+" of "+str(total_counter)+" particles were re-assigned to new classes.\nThis is "+str(round(100*float(change_counter)/float(total_counter), 1))+" percent of the input pool.\n\n")
+			status = self.folder+": iteration "+str(iteration)+", "+str(round(100*float(change_counter)/float(total_counter), 1))+"% of "+converge.clean_large_numbers(total_counter)+" particles re-assigned"
+		else:
+			g.write("Loaded data for "+str(total_counter)+" particles.\n\n")
+			status = self.folder+": iteration "+str(iteration)+", "+converge.clean_large_numbers(total_counter)+" particles"
+		g.close()
+
+		self.plotter.submit(converge.class_counter(self.history), join(self.folder, "converge_"+converge.no_ext(os.path.basename(star_path))+".png"), self.history.iteration_numbers)
+		self.history.save(self.checkpoint, star_path)
+		return status
+
+	def start_watching(self, loop):
+		self.loop = loop
+		if self.watcher != None:
+			return
+		self.watcher = converge.DirectoryWatcher(self.folder)
+		self.changed = asyncio.Event()
+		if self.watcher.fd != None:
+			loop.add_reader(self.watcher.fd, self.on_event)
+
+	def on_event(self):
+		self.watcher.read_events()
+		self.changed.set()
+
+	async def wait(self, timeout):
+		"""
+		Returns after the job folder changes, or after at most timeout seconds.
+
+		"""
+		if self.watcher.fd == None:
+			await asyncio.sleep(timeout)
+			return
+		self.changed.clear()
+		try:
+			await asyncio.wait_for(self.changed.wait(), timeout)
+		except asyncio.TimeoutError:
+			pass
+
+	def close(self):
+		if self.watcher != None:
+			if self.watcher.fd != None:
+				self.loop.remove_reader(self.watcher.fd)
+			self.watcher.close()
+			self.watcher = None
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Tracks the convergence of classes in many relion classification jobs at once.")
+	parser.add_argument("folders", help="relion Class2D/Class3D job folders to watch", nargs="*")
+	parser.add_argument("--scan", help="also watch every job found in this folder (e.g. Class2D), including jobs started later; repeat for several folders", action="append", default=[])
+	parser.add_argument("--plots", help="write a png plot for every iteration (all), only keep an up-to-date converge_latest.png in each job folder (latest), or only write the logs (none) (default: latest)", choices=["all", "latest", "none"], default="latest")
+	parser.add_argument("--interval", help="seconds between checks of a job folder when inotify is not available (default: 5)", type=float, default=5.0)
+	parser.add_argument("--restart", help="ignore any checkpoints and start every job again from iteration 1", action="store_true")
+	args = parser.parse_args()
+	if (len(args.folders) == 0) and (len(args.scan) == 0):
+		print("Check usage: python converge_daemon.py jobFolder [jobFolder ...] [--scan Class2D]")
+		sys.exit(0)
+	for folder in args.folders+args.scan:
+		if isdir(folder) == False:
+			print("ERROR: "+folder+" is not a folder.")
+			print("Exiting.")
+			sys.exit(1)
+	main(args.folders, args.scan, args.plots, args.restart, args.interval)
\ No newline at end of file
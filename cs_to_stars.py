@@ -11,206 +11,770 @@ Revised to accommodate data format changes in RELION 4/5 and CryoSPARC 4.
 """
 
 import sys
-import numpy as np
 import os
 from os import listdir
 from os.path import isfile, join
+import json
+import time
+import shutil
+import hashlib
 import argparse
-parser = argparse.ArgumentParser()
-parser.add_argument("--cs", help="cryosparc particle pick file")
-parser.add_argument("--star", help="relion migrographs_ctf.star file")
-parser.add_argument("--no_nudge", help="turn off dynamic selection in cs files", action="store_true")
-parser.add_argument("--flipx", help="invert coordinates in x-axis", action="store_true")
-parser.add_argument("--flipy", help="invert coordinates in y-axis", action="store_true")
-parser.add_argument("--swapxy", help="swap x- and y-coordinates", action="store_true")
-args = parser.parse_args()
+from functools import partial
+from contextlib import contextmanager
+
+# Prefixes and suffixes of the cs fields holding particle locations (the location/ fields of both cryosparc 3.x picks
+# and 4.x extracted particles; blob/ and pick_stats/ hold the particle image and pick scores, not locations)
+CS_FIELD_PREFIXES = ["location/"]
+CS_FIELD_SUFFIXES = ["micrograph_path", "micrograph_shape", "center_x_frac", "center_y_frac"]
+# Header of the autopick star files written for each micrograph
+STAR_HEADER = "\n# version 30001\n\ndata_\n\nloop_ \n_rlnCoordinateX #1 \n_rlnCoordinateY #2 \n_rlnAutopickFigureOfMerit #3 \n_rlnClassNumber #4 \n_rlnAnglePsi #5 \n"
+# Layout of each coordinate row, and the number of integer digits that fit its coordinate columns
+STAR_ROW = "%12.1f %12.1f     0.080000            0     0.000000 \n"
+COORD_DIGITS = 10
+# Manifest of per-micrograph coordinate hashes kept in the output folder by --incremental runs
+MANIFEST_NAME = ".cs_to_stars_manifest.json"
+# Size limit of the micrograph name cache folder
+CACHE_MAX_BYTES = 256*1024*1024
+# Number of star files between progress reports
+PROGRESS_STEP = 1000
+# Number of particles sampled when positional field detection needs to estimate column variability
+SAMPLE_SIZE = 20000
+
+
+def build_parser():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--cs", help="cryosparc particle pick file (repeat to convert several files against the same star file)", action="append")
+	parser.add_argument("--star", help="relion migrographs_ctf.star file")
+	parser.add_argument("--out", help="output folder for each --cs file, in the same order (default: Raw_data for a single file, <cs file name>/Raw_data for several)", action="append")
+	parser.add_argument("--cache_dir", help="folder caching parsed star files between runs (default: $CS_TO_STARS_CACHE or ~/.cache/cs_to_stars)")
+	parser.add_argument("--no_cache", help="always re-parse the star file", action="store_true")
+	parser.add_argument("--no_nudge", help="turn off dynamic selection in cs files", action="store_true")
+	parser.add_argument("--flipx", help="invert coordinates in x-axis", action="store_true")
+	parser.add_argument("--flipy", help="invert coordinates in y-axis", action="store_true")
+	parser.add_argument("--swapxy", help="swap x- and y-coordinates", action="store_true")
+	parser.add_argument("--archive", help="write the star files into this .tar, .tar.gz or .zip archive instead of a Raw_data folder")
+	parser.add_argument("--incremental", help="only rewrite star files whose picks changed since the last --incremental run, without prompting", action="store_true")
+	parser.add_argument("--yes", help="overwrite existing star files (or archives) without asking, e.g. when running from a script or cron", action="store_true")
+	parser.add_argument("--jobs", help="number of threads writing star files in parallel (default: 1)", type=int, default=1)
+	parser.add_argument("--procs", help="number of cs files converted in parallel processes (default: 1)", type=int, default=1)
+	parser.add_argument("--match_procs", help="number of processes matching micrograph names, each on a shard of the memory-mapped cs file (default: 1)", type=int, default=1)
+	parser.add_argument("--profile", help="write the wall time, CPU time, peak memory and throughput of each conversion phase to this JSON file")
+	parser.add_argument("--cprofile", help="also write cProfile statistics of the whole run to this file")
+	parser.add_argument("--merge", help="merge the picks of all --cs files into one set of star files, dropping picks within this many pixels of a pick from an earlier --cs file", type=float)
+	parser.add_argument("--chunk_size", "--chunk-size", help="stream the cs file in windows of this many particles to bound memory use (default: convert all at once)", type=int, default=0)
+	return parser
 
 
 def main(args):#inCs, inMcgs):#, args):
-	# Parse arguments -> simple variables for back compatibility
-	inCs = args.cs 
-	inMcgs = args.star
-	force_no_nudge = args.no_nudge
-
-	# Check for the Raw_data subdirectory and delete any contents
-	if os.path.isdir("./Raw_data") == False:
-		os.mkdir("./Raw_data")
-	else:
-		print("\nDetected a Raw_data folder in this directory.")
-	onlyfiles = [f for f in listdir("./Raw_data/") if isfile(join("./Raw_data", f))]
-	if len(onlyfiles) > 0:
-		response = input("Files detected in the Raw_data folder. Okay to overwrite them? [y/n] ")
-		if response in ["Y", "y"]:
-			print("Okay.  Deleting files in Raw_Data...")
-			for item in onlyfiles:
-				os.remove(join("./Raw_data/", item))
+	# Pair each cs file with its output folder (merged picks all go to a single folder)
+	if args.merge != None:
+		if len(args.cs) < 2:
+			raise ConversionError("--merge needs at least two --cs files.")
+		if args.chunk_size > 0:
+			raise ConversionError("--merge cannot be combined with --chunk_size, since all picks of a micrograph are needed at once.")
+		if args.out == None:
+			out_dirs = ["Raw_data"]
+		elif len(args.out) == 1:
+			out_dirs = args.out
+		else:
+			raise ConversionError("Give a single --out folder for the merged picks.")
+	elif args.out == None:
+		if len(args.cs) == 1:
+			out_dirs = ["Raw_data"]
 		else:
-			print("Exiting.")
-			exit()
+			out_dirs = [join(os.path.splitext(os.path.basename(inCs))[0], "Raw_data") for inCs in args.cs]
+	elif len(args.out) == len(args.cs):
+		out_dirs = args.out
+	else:
+		raise ConversionError("Give one --out folder for each --cs file.")
+	if len(set(out_dirs)) < len(out_dirs):
+		raise ConversionError("Each --cs file needs its own output folder.")
+	if (args.archive != None) and (len(out_dirs) > 1):
+		raise ConversionError("--archive can only be used with a single --cs file.")
+	check_options(args.archive, args.incremental, args.chunk_size)
 
-	# Read in the cs file as a np array
-	print("Reading the cryosparc file...")
-	f = np.load(inCs)
+	# Check the outputs up front, so that no prompt is needed once conversion starts
+	for out_dir in out_dirs:
+		try:
+			prepare_output(out_dir, args.archive, args.incremental)
+		except OutputExistsError as e:
+			if args.yes == False:
+				try:
+					response = input(str(e)+" Okay to overwrite? [y/n] ")
+				except (EOFError, RuntimeError):
+					raise ConversionError(str(e)+"\nThere is no terminal to confirm overwriting them; use --yes to overwrite without asking.")
+				if response not in ["Y", "y"]:
+					print("Exiting.")
+					sys.exit(0)
+			prepare_output(out_dir, args.archive, args.incremental, overwrite=True)
 
-	# Parse the micrograph names from the ctf.star file
+	if args.profile != None:
+		profiler = PhaseProfiler()
+	else:
+		profiler = None
+
+	# Parse the micrograph names from the ctf.star file (or the cache) and index them once for all cs files
 	print("Parsing micrograph names from star file...")
-	mcg_parsed_names = parse_star(inMcgs)
+	star_index = load_star_index(args.star, args.cache_dir, args.no_cache == False, profiler)
+
+	options = {"flipx": args.flipx, "flipy": args.flipy, "swapxy": args.swapxy, "no_nudge": args.no_nudge, "archive": args.archive, "incremental": args.incremental, "overwrite": True, "jobs": args.jobs, "match_procs": args.match_procs, "chunk_size": args.chunk_size, "star_index": star_index}
+	if args.merge != None:
+		# Convert each cs file without writing, then merge the picks in the order the files were given
+		coord_sets = []
+		for inCs in args.cs:
+			print("\nConverting "+inCs+"...")
+			coord_sets.append(convert(inCs, flipx=args.flipx, flipy=args.flipy, swapxy=args.swapxy, no_nudge=args.no_nudge, match_procs=args.match_procs, star_index=star_index, profiler=profiler))
+		total = sum([len(coord_set.x) for coord_set in coord_sets])
+		print("\nMerging "+clean_large_numbers(total)+" picks from "+str(len(coord_sets))+" cryosparc files...")
+		with profile_phase(profiler, "merging", total):
+			merged = merge_picks(coord_sets, args.merge)
+		kept = len(merged.x)
+		print(clean_large_numbers(total-kept)+" duplicate picks dropped, "+clean_large_numbers(kept)+" picks kept.")
+		with profile_phase(profiler, "writing", kept):
+			write_coordinates(merged, out_dirs[0], args.archive, args.incremental, args.jobs)
+	elif (args.procs > 1) and (len(args.cs) > 1):
+		from concurrent.futures import ProcessPoolExecutor, as_completed
+		print("Converting "+str(len(args.cs))+" cryosparc files in "+str(args.procs)+" processes...")
+		with ProcessPoolExecutor(max_workers=args.procs) as pool:
+			futures = {}
+			for i in range(0, len(args.cs)):
+				# Each worker times its own phases, which are added to the profile as they come back
+				if profiler != None:
+					options["profiler"] = PhaseProfiler()
+				futures[pool.submit(convert_worker, args.cs[i], out_dirs[i], options)] = i
+			for future in as_completed(futures):
+				worker_profiler = future.result()
+				if profiler != None:
+					profiler.records.extend(worker_profiler.records)
+				print("Finished "+args.cs[futures[future]]+" -> "+out_dirs[futures[future]])
+	else:
+		options["profiler"] = profiler
+		for i in range(0, len(args.cs)):
+			if len(args.cs) > 1:
+				print("\nConverting "+args.cs[i]+" -> "+out_dirs[i])
+			convert(args.cs[i], None, out_dirs[i], **options)
+
+	if profiler != None:
+		profiler.write(args.profile)
+		print("Profile written to "+args.profile)
+
+	# Exit
+	print("Done.")
+
+
+class ConversionError(Exception):
+	"""
+	Raised when a cs file cannot be converted, with a message explaining why.
+
+	"""
+	pass
+
+
+class OutputExistsError(ConversionError):
+	"""
+	Raised when converting would overwrite existing star files or an existing archive.
+
+	"""
+	pass
+
+
+def convert(cs_path, star_path=None, out_dir=None, flipx=False, flipy=False, swapxy=False, no_nudge=False, archive=None, incremental=False, overwrite=False, jobs=1, match_procs=1, chunk_size=0, cache_dir=None, use_cache=True, star_index=None, profiler=None):
+	"""
+	Converts the particle coordinates of a cryosparc cs file into relion autopick coordinates, matching micrographs
+	against star_path (or a star_index already returned by load_star_index).
+
+	The star files are written into out_dir (or into the archive file), refusing to overwrite existing ones unless
+	overwrite is set; incremental updates out_dir in place as with --incremental.  With match_procs > 1, micrograph
+	names are matched by a pool of processes reading shards of the memory-mapped cs file.  Returns the coordinates as
+	CoordinateGroups, except when streaming with chunk_size, which returns None.  Raises ConversionError if the
+	conversion is not possible.
 
-	# Get the starting index for the particle location info
-	print("Matching micrograph names between cs and star files...")
-	start_index, x_index = infer_index(f)
-
-	# Match star to cs entries and save the per-particle micrograph names
-	mcg_names = []
-	counter = 1
-	previous_soln = "this_is_a_placeholder_name_hopefully_noone_ever_names_their_files_this_starfish_gorilla_massachusetts_taco_tarnish.mrc"
-	for i in range(0, len(f)):
-		#if counter < 20:
-		found_match_flag = False
-		if counter % 10000 == 0:
-			print(str(clean_large_numbers(counter))+" / "+str(clean_large_numbers(len(f))))
-		# Try the previous solution before brute-forcing
-		if no_ext(previous_soln) in no_dot(str(f[i][start_index])):
-			mcg_names.append(previous_soln)
-			found_match_flag = True
-		# Else brute-force it
+	"""
+	check_options(archive, incremental, chunk_size)
+	if (out_dir == None) and (archive == None) and (chunk_size > 0):
+		raise ConversionError("Streaming with chunk_size needs an output folder.")
+	if star_index == None:
+		star_index = load_star_index(star_path, cache_dir, use_cache, profiler)
+	if (out_dir != None) or (archive != None):
+		prepare_output(out_dir, archive, incremental, overwrite)
+
+	# Open the cs file as a memory-mapped np array
+	print("Reading the cryosparc file...")
+	with profile_phase(profiler, "load") as record:
+		f = load_cs(cs_path)
+		record["items"] = len(f)
+
+	# Identify the micrograph path, shape and coordinate fields in the cs file
+	print("Identifying particle location fields in the cryosparc file...")
+	with profile_phase(profiler, "schema", len(f)):
+		schema = resolve_schema(f, no_nudge, profiler)
+	if schema == None:
+		raise ConversionError("Could not find particle location info in the cryosparc file "+cs_path+".\nNot all cryosparc files contain particle coordinate info - try a different particle file from the same job.")
+	transform = (flipx, flipy, swapxy)
+
+	match_pool = None
+	match_shards = None
+	if match_procs > 1:
+		import numpy as np
+		if isinstance(f, np.memmap):
+			from concurrent.futures import ProcessPoolExecutor
+			match_pool = ProcessPoolExecutor(max_workers=match_procs)
+			match_shards = partial(match_micrographs_sharded, match_pool, match_procs, cs_path, schema[0])
 		else:
-			for mcg_name in mcg_parsed_names:
-				# Save operations by doing calculations once
-				target = no_dot(str(f[i][start_index]))
-				if no_ext(mcg_name) in target:
-					mcg_names.append(mcg_name)
-					previous_soln = mcg_name
-					found_match_flag = True
-					break
-		# Exit if the star and cs files don't have matching micrograph names
-		if found_match_flag == False:
-			try:
-				print("\nERROR: There was no match found for the following micrograph: "+target)
-			except:
-				print("\nERROR: There was no match found for at least one micrograph specified in the cs file.")
-			print("This can happen if your cryosparc and relion jobs didn't use the same input raw micrographs.")
-			print("Perhaps the .cs file and the .star file don't correspond to the same data?")
-			try:
-				print("DEBUG: start_index = "+str(start_index))
-			except:
-				pass
-			print("Exiting...")
-			exit()
-		counter += 1
+			print("NOTICE: "+cs_path+" cannot be memory-mapped, so micrograph names are matched in a single process.")
+	try:
+		return convert_particles(f, cs_path, schema, star_index, transform, out_dir, archive, incremental, jobs, chunk_size, match_shards, profiler)
+	finally:
+		if match_pool != None:
+			match_pool.shutdown()
 
-	# Define indeces for x_frac and y_frac by checking for overly consistent coordinates
-	# Check if x_index and x_index+1 are floats
-	if (f[0][x_index].dtype == "float32") and (f[0][x_index] <= 1.0) and (f[0][x_index+1].dtype == "float32") and (f[0][x_index+1] <= 1.0):
-		need_nudge_flag = True
+
+def convert_particles(f, cs_path, schema, star_index, transform, out_dir, archive, incremental, jobs, chunk_size, match_shards, profiler):
+	"""
+	Converts the particles of an opened cs file once its schema is known, in chunks or all at once, and writes the
+	outputs.  Returns the coordinates as CoordinateGroups, or None when streaming.
+
+	"""
+	mcg_parsed_names, name_index, key_lengths = star_index
+	if chunk_size > 0:
+		# Stream fixed-size windows of particles through matching, transformation and star writing
+		print("Converting particles in chunks of "+clean_large_numbers(chunk_size)+"...")
+		resolved = {}
+		started = set()
+		for begin in range(0, len(f), chunk_size):
+			end = min(begin+chunk_size, len(f))
+			print(clean_large_numbers(end)+" / "+clean_large_numbers(len(f)))
+			with profile_phase(profiler, "projection", end-begin):
+				window = project_fields(f[begin:end], schema)
+			groups = convert_window(window, schema, name_index, key_lengths, mcg_parsed_names, transform, resolved, profiler, match_shards, begin)
+			with profile_phase(profiler, "writing", end-begin):
+				append_star_files(groups, started, jobs, out_dir)
+		with profile_phase(profiler, "writing"):
+			finish_star_files(started, jobs, out_dir)
+		return None
+
+	# Keep only the four location columns in memory
+	with profile_phase(profiler, "projection", len(f)):
+		f = project_fields(f, schema)
+	print("Matching micrograph names and transforming particle coordinates...")
+	groups = convert_window(f, schema, name_index, key_lengths, mcg_parsed_names, transform, None, profiler, match_shards)
+
+	# Write out the coords as "autopicking" star files
+	with profile_phase(profiler, "writing", len(f)):
+		write_coordinates(groups, out_dir, archive, incremental, jobs)
+
+	return groups
+
+
+def write_coordinates(groups, out_dir=None, archive=None, incremental=False, jobs=1):
+	"""
+	Writes grouped coordinates as autopick star files, incrementally into out_dir, into the archive file, or into
+	out_dir from scratch.  Nothing is written if neither out_dir nor archive is given.
+
+	"""
+	if incremental == True:
+		print("Updating star files in "+out_dir+"...")
+		written, kept, removed = write_star_files_incremental(groups, jobs, out_dir)
+		print(clean_large_numbers(written)+" star files written, "+clean_large_numbers(kept)+" unchanged, "+clean_large_numbers(removed)+" removed.")
+	elif archive != None:
+		print("Writing star files to "+archive+"...")
+		write_star_archive(groups, archive)
+	elif out_dir != None:
+		print("Writing star files...")
+		write_star_files(groups, jobs, out_dir)
+
+
+def convert_worker(cs_path, out_dir, options):
+	"""
+	Runs convert in a worker process and only sends back the profiler, rather than the coordinates.
+
+	"""
+	convert(cs_path, None, out_dir, **options)
+	return options.get("profiler")
+
+
+def check_options(archive, incremental, chunk_size):
+	"""
+	Raises ConversionError for output options that cannot be combined.
+
+	"""
+	if (archive != None) and (chunk_size > 0):
+		raise ConversionError("--archive cannot be combined with --chunk_size, since archive members cannot be appended to.")
+	if (incremental == True) and ((archive != None) or (chunk_size > 0)):
+		raise ConversionError("--incremental cannot be combined with --archive or --chunk_size.")
+
+
+def prepare_output(out_dir, archive=None, incremental=False, overwrite=False):
+	"""
+	Checks an output folder (or archive file) before conversion.  Existing star files are deleted, or an
+	OutputExistsError raised if overwrite is not set.  An incremental output folder is only checked: its star files
+	are reconciled against the manifest after conversion, and a folder without a manifest needs overwrite set.
+
+	"""
+	if incremental == True:
+		recover_swap(out_dir)
+		if (os.path.isdir(out_dir) == True) and (os.path.isfile(join(out_dir, MANIFEST_NAME)) == False):
+			onlyfiles = [f for f in listdir(out_dir) if isfile(join(out_dir, f))]
+			if len(onlyfiles) > 0:
+				if overwrite == False:
+					print("\nDetected a "+out_dir+" folder.")
+					raise OutputExistsError("Files detected in the "+out_dir+" folder, which has no manifest from a previous --incremental run.")
+				print("Okay.  Star files in "+out_dir+" will be replaced; any other files are kept.")
+	elif archive != None:
+		# Check for an existing archive
+		if os.path.exists(archive) and (overwrite == False):
+			raise OutputExistsError("The archive "+archive+" already exists.")
 	else:
-		need_nudge_flag = False
+		# Check for the output subdirectory and delete any contents
+		if os.path.isdir(out_dir) == False:
+			os.makedirs(out_dir)
+		elif overwrite == False:
+			print("\nDetected a "+out_dir+" folder.")
+		onlyfiles = [f for f in listdir(out_dir) if isfile(join(out_dir, f))]
+		if len(onlyfiles) > 0:
+			if overwrite == False:
+				raise OutputExistsError("Files detected in the "+out_dir+" folder.")
+			print("Okay.  Deleting files in "+out_dir+"...")
+			for item in onlyfiles:
+				os.remove(join(out_dir, item))
 
-	# If all three are coordinate floats of 1 or less, iterate over the particles and look repetition in positions +2, +3, and +4
-	problem_indeces = []
-	if start_index == x_index:
-		if need_nudge_flag == True:
-			for i in [2, 3, 4]:
-				nonunique_items = []
-				for j in range(0, len(f)):
-					nonunique_items.append(f[j][start_index+i])
-				if len(set(nonunique_items)) < len(f) * 0.01:
-					problem_indeces.append(i)
-			if force_no_nudge == True:
-				print("\nWARNING: --no_nudge flag was invoked by user.\n\tThe script is forced to guess based on where they usually are.\n\tThe output coordinates may not be correct!\n\tPlease verify that your output pick positions match what you expect.\n\tProceeding...\n")
-				adj_start_index = start_index
-			elif (2 in problem_indeces) and (len(problem_indeces) == 1):
-				print("\nNOTICE: Particle coordinates may have been stored in an unexpected place in the cryosparc file provided.\n\tWe have made our best guess as to where in the file your pick coordinates are.\n\tWe're quite confident they *should* be correct, but can't guarantee it.\n\tThis probably isn't a problem, but please carefully verify that your output pick positions match what you expect.\n\tTo disable this dynamic selection and fall back to where the coordinates *usually* are, rerun\n\t\t the program with the --no_nudge flag.\n\tIf this continues to be an issue, try a different cryosparc output file.\n\tProceeding...\n")
-				adj_start_index = start_index + 1 # nudged start index to accomodate the extra cryosparc data
-			else:
-				print("\nWARNING: We could not unambiguously identify the particle coordinates in this cryosparc file.\n\tThe script is forced to guess based on where they usually are.\n\tThe output coordinates may not be correct!\n\tPlease verify that your output pick positions match what you expect.\n\tProceeding...\n")
-				adj_start_index = start_index
+
+def load_star_index(star_path, cache_dir=None, use_cache=True, profiler=None):
+	"""
+	Parses the micrograph names of a star file (or takes them from the cache) and indexes them for matching.
+	Returns the (names, name index, key lengths) tuple that convert takes as star_index.
+
+	"""
+	with profile_phase(profiler, "parse_star") as record:
+		if use_cache == False:
+			mcg_parsed_names = parse_star(star_path)
+			name_index, key_lengths = build_name_index(mcg_parsed_names)
 		else:
-			adj_start_index = start_index
+			mcg_parsed_names, name_index, key_lengths = load_name_index(star_path, cache_dir)
+		record["items"] = len(mcg_parsed_names)
+
+	return mcg_parsed_names, name_index, key_lengths
+
+
+class PhaseProfiler(object):
+	"""
+	Records the wall time, CPU time, memory and throughput of the named phases of a conversion.  A phase that runs
+	several times (e.g. once per chunk) is summed in the report.
+
+	Memory is recorded as the resident memory at the start and end of each phase and, on Linux, as the peak resident
+	memory reached during the phase: the kernel's high-water mark is reset as each phase starts, and the peak of a
+	nested phase also counts towards the phases around it.  Elsewhere the per-phase peak is not available (None).
+
+	"""
+	def __init__(self):
+		self.records = []
+		self.active = []
+		self.start_wall = time.perf_counter()
+		self.start_cpu = time.process_time()
+
+	@contextmanager
+	def phase(self, name, items=None):
+		record = {"phase": name, "items": items, "peak_rss_mb": None}
+		reset = reset_peak_rss()
+		record["start_rss_mb"] = proc_memory_mb("VmRSS")
+		self.active.append(record)
+		wall = time.perf_counter()
+		cpu = time.process_time()
+		try:
+			yield record
+		finally:
+			record["wall_seconds"] = time.perf_counter()-wall
+			record["cpu_seconds"] = time.process_time()-cpu
+			record["end_rss_mb"] = proc_memory_mb("VmRSS")
+			self.active.remove(record)
+			if reset == True:
+				peak = max(proc_memory_mb("VmHWM") or 0, record["peak_rss_mb"] or 0)
+				for item in [record]+self.active:
+					item["peak_rss_mb"] = max(item["peak_rss_mb"] or 0, peak)
+			self.records.append(record)
+
+	def report(self):
+		phases = []
+		by_name = {}
+		for record in self.records:
+			if record["phase"] not in by_name:
+				by_name[record["phase"]] = {"phase": record["phase"], "calls": 0, "items": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_rss_mb": None, "rss_change_mb": None}
+				phases.append(by_name[record["phase"]])
+			summary = by_name[record["phase"]]
+			summary["calls"] += 1
+			summary["wall_seconds"] += record["wall_seconds"]
+			summary["cpu_seconds"] += record["cpu_seconds"]
+			if record["items"] != None:
+				summary["items"] += record["items"]
+			if record["peak_rss_mb"] != None:
+				summary["peak_rss_mb"] = max(summary["peak_rss_mb"] or 0, record["peak_rss_mb"])
+			if (record["start_rss_mb"] != None) and (record["end_rss_mb"] != None):
+				summary["rss_change_mb"] = (summary["rss_change_mb"] or 0)+record["end_rss_mb"]-record["start_rss_mb"]
+		for summary in phases:
+			if (summary["items"] > 0) and (summary["wall_seconds"] > 0):
+				summary["items_per_sec"] = summary["items"]/summary["wall_seconds"]
+			else:
+				summary["items_per_sec"] = None
+
+		# Resetting the high-water mark per phase also resets the lifetime peak, so the phase peaks are included
+		peaks = [record["peak_rss_mb"] for record in self.records if record["peak_rss_mb"] != None]+[peak_rss_mb()]
+		peaks = [peak for peak in peaks if peak != None]
+		total = {"wall_seconds": time.perf_counter()-self.start_wall, "cpu_seconds": time.process_time()-self.start_cpu, "peak_rss_mb": max(peaks) if len(peaks) > 0 else None}
+		return {"total": total, "phases": phases}
+
+	def write(self, inFile):
+		report = self.report()
+		g = open(inFile, "w")
+		json.dump(report, g, indent=1)
+		g.close()
+
+		# Print a short summary
+		print("\nPhase                 wall (s)     cpu (s)   peak RSS (MB)  RSS change (MB)         items/s")
+		for summary in report["phases"]:
+			rate = "-" if summary["items_per_sec"] == None else clean_large_numbers(int(summary["items_per_sec"]))
+			rss = "-" if summary["peak_rss_mb"] == None else str(round(summary["peak_rss_mb"], 1))
+			change = "-" if summary["rss_change_mb"] == None else str(round(summary["rss_change_mb"], 1))
+			print(summary["phase"].ljust(18)+str(round(summary["wall_seconds"], 3)).rjust(12)+str(round(summary["cpu_seconds"], 3)).rjust(12)+rss.rjust(16)+change.rjust(17)+rate.rjust(16))
+
+
+@contextmanager
+def profile_phase(profiler, name, items=None):
+	"""
+	Times a phase with profiler, or does nothing when profiler is None.
+
+	"""
+	if profiler == None:
+		yield {}
 	else:
-		adj_start_index = x_index - 2
-	
-	# Load the particles into a dictionary
-	print("Transforming particle coordinates...")
-	coord_dict = {}
-	counter = 1
-	for i in range(0, len(f)):
-		# Pull micrograph name and add to dictionary
-		mcg_name = mcg_names[i]
-		if counter % 50000 == 0:
-			print(str(clean_large_numbers(counter))+" / "+str(clean_large_numbers(len(f))))
-		counter += 1
-		if mcg_name not in coord_dict:
-			coord_dict[mcg_name] = {"x":[], "y":[]}
-
-		# Calculate transformed x and y coords
-		h = f[i][start_index+1][0]
-		l = f[i][start_index+1][1]
-		if args.flipx == False:
-			x_frac = f[i][adj_start_index+2]
-		else:
-			x_frac = 1 - f[i][adj_start_index+2]
-		if args.flipy == False:
-			y_frac = f[i][adj_start_index+3]
-		else:
-			y_frac = 1 - f[i][adj_start_index+3]
+		with profiler.phase(name, items) as record:
+			yield record
 
-		if args.swapxy == False: #swapxy implementation
-			x_coord = round((l*x_frac), 0)
-			y_coord = round(h-(h*y_frac), 0)
-		else:
-			x_coord = round(h-(h*y_frac), 0)
-			y_coord = round((l*x_frac), 0)
 
-		# Add to dictionary
-		coord_dict[mcg_name]["x"].append(str(round(x_coord, 6)))
-		coord_dict[mcg_name]["y"].append(str(round(y_coord, 6)))
+def reset_peak_rss():
+	"""
+	Resets the peak resident memory (VmHWM) of this process, so that it can be read per phase.  Returns False where
+	this is not supported (anywhere but Linux).
 
-	# Write out the coords as "autopicking" star files
-	print("Writing star files...")
-	counter = 1
-	for item in coord_dict.keys():
-		if counter % 1000 == 0:
-			print(clean_large_numbers(str(counter))+" / "+str(clean_large_numbers(len(coord_dict.keys()))))
-		counter += 1
-		g = open("Raw_data/"+no_ext(item)+"_autopick.star", "w", newline="")
-		g.write("\n# version 30001\n\ndata_\n\nloop_ \n_rlnCoordinateX #1 \n_rlnCoordinateY #2 \n_rlnAutopickFigureOfMerit #3 \n_rlnClassNumber #4 \n_rlnAnglePsi #5 \n")
-		for i in range(0, len(coord_dict[item]["x"])):
-			g.write(line_writer(coord_dict[item]["x"][i], coord_dict[item]["y"][i]))
-		g.write("\n")
+	"""
+	try:
+		g = open("/proc/self/clear_refs", "w")
+		g.write("5")
 		g.close()
+	except (IOError, OSError):
+		return False
+	return True
 
-	# Exit
-	print("Done.")
+
+def proc_memory_mb(field):
+	"""
+	Returns a memory figure of this process in MB from /proc/self/status (e.g. VmRSS for the current and VmHWM for
+	the peak resident memory), or None where it is unavailable.
+
+	"""
+	try:
+		g = open("/proc/self/status", "r")
+		for line in g:
+			if line.startswith(field+":"):
+				g.close()
+				return int(line.split()[1])/1024.0
+		g.close()
+	except (IOError, OSError, ValueError, IndexError):
+		pass
+	return None
+
+
+def peak_rss_mb():
+	"""
+	Returns the peak resident memory over the whole lifetime of this process in MB, or None where the resource
+	module is unavailable.
+
+	"""
+	try:
+		import resource
+	except ImportError:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == "darwin":
+		return peak/(1024.0*1024.0)
+	return peak/1024.0
+
+
+def load_cs(inCs):
+	"""
+	Opens a cs file as a read-only memory-mapped np array, so that only the fields that are accessed are read from
+	disk.  Files holding python objects cannot be memory-mapped and are loaded in full instead.
+
+	"""
+	import numpy as np
+	try:
+		return np.load(inCs, mmap_mode="r")
+	except ValueError:
+		return np.load(inCs)
+
+
+def project_fields(np_array, fields):
+	"""
+	Copies the requested fields of a cs array into a compact structured array, one strided column at a time.
+
+	"""
+	import numpy as np
+	projected = np.empty(len(np_array), dtype=[(field, np_array.dtype.fields[field][0]) for field in fields])
+	for field in fields:
+		projected[field] = np_array[field]
+
+	return projected
 
 
 def parse_star(inMcgs):
-	# Open file
-	f = open(inMcgs, "r")
-	lines = f.readlines()
-
-	# Find the position of "_rlnMicrographName" in the star file loop definition
-	for i in range(0, len(lines)):
-		if "loop_" in lines[i]:
-			loop_start = i
-			for j in range(i+1, len(lines)):
-				if "_rlnMicrographName " in lines[j]:
-					parse_pos = int(lines[j][lines[j].find("#")+1:])-1
-					break
-
-	# Isolate the micrograph name from each line of the star file
-	mcgs = []
-	for i in range(loop_start+1, len(lines)):
-		if lines[i][0] != "_":
-			mcgs.append(last_slash(lines[i].split(" ")[parse_pos]))
-
-	# Final check for zero-length strings
-	clean_mcgs = []
-	for i in range(0, len(mcgs)):
-		if len(mcgs[i]) > 0:
-			clean_mcgs.append(mcgs[i])
-	
-	return clean_mcgs
+	"""
+	Returns the micrograph names (without their folders) listed in a relion micrographs star file.  RELION 3.1+ files
+	keep them in the data_micrographs block; older files have a single loop.
+
+	"""
+	columns = read_star_columns(inMcgs, ["_rlnMicrographName"], "data_micrographs")
+	if columns == None:
+		columns = read_star_columns(inMcgs, ["_rlnMicrographName"])
+	if columns == None:
+		return []
+
+	# Isolate the micrograph name from each row, dropping zero-length strings
+	mcgs = [last_slash(name) for name in columns["_rlnMicrographName"].tolist()]
+	return [mcg for mcg in mcgs if len(mcg) > 0]
+
+
+def read_star_columns(inStar, columns, block=None):
+	"""
+	Streams a star file and returns the requested columns of a loop as a dictionary of np string arrays, or None if
+	no loop has all of them.  block restricts the search to one named data block (e.g. "data_micrographs");
+	otherwise the last loop with all the columns is used.  Rows are split on any run of whitespace and only the
+	requested columns are kept in memory.
+
+	"""
+	import numpy as np
+	current_block = None
+	labels = {}
+	in_header = False
+	found = None
+	values = None
+
+	g = open(inStar, "r")
+	for line in g:
+		stripped = line.strip()
+		if (len(stripped) == 0) or (stripped[0] == "#"):
+			continue
+		if stripped.startswith("data_"):
+			current_block = stripped.split()[0]
+			labels = {}
+			in_header = False
+			values = None
+		elif stripped.startswith("loop_"):
+			labels = {}
+			in_header = True
+			values = None
+		elif stripped[0] == "_":
+			# Labels only describe columns inside a loop header; key-value pairs are skipped.  The column number
+			# after "#" is used when present, otherwise the label order.
+			if in_header == True:
+				parts = stripped.split()
+				if (len(parts) > 1) and (parts[1][0] == "#"):
+					labels[parts[0]] = int(parts[1][1:])-1
+				else:
+					labels[parts[0]] = len(labels)
+		elif len(labels) > 0:
+			if in_header == True:
+				# First row of a loop: decide whether it holds the requested columns
+				in_header = False
+				if ((block == None) or (current_block == block)) and all([column in labels for column in columns]):
+					positions = [labels[column] for column in columns]
+					max_split = max(positions)+1
+					values = [[] for column in columns]
+					found = values
+			if values != None:
+				fields = stripped.split(None, max_split)
+				if len(fields) >= max_split:
+					for i in range(0, len(positions)):
+						values[i].append(fields[positions[i]])
+	g.close()
+
+	if found == None:
+		return None
+	result = {}
+	for i in range(0, len(columns)):
+		result[columns[i]] = np.array(found[i], dtype=str)
+	return result
+
+
+def load_name_index(inMcgs, cache_dir=None):
+	"""
+	Returns the micrograph names of a star file along with their name index (see build_name_index).  The parsed
+	names and their extension-free keys are cached in cache_dir, and reused as long as the star file's path, size,
+	modification time and content hash are unchanged.
+
+	"""
+	import numpy as np
+	if cache_dir == None:
+		cache_dir = os.environ.get("CS_TO_STARS_CACHE", join(os.path.expanduser("~"), ".cache", "cs_to_stars"))
+	abs_path = os.path.abspath(inMcgs)
+	stat = os.stat(abs_path)
+	cache_file = join(cache_dir, hashlib.sha1(abs_path.encode()).hexdigest()+".npz")
+
+	# Use the cached index if it still describes this star file
+	try:
+		cached = np.load(cache_file)
+		meta = cached["meta"].tolist()
+		if (meta[:3] == [abs_path, str(stat.st_size), str(stat.st_mtime)]) and (meta[3] == file_digest(abs_path)):
+			mcg_parsed_names = cached["names"].tolist()
+			name_index, key_lengths = build_name_index(mcg_parsed_names, cached["keys"].tolist())
+			cached.close()
+			os.utime(cache_file, None)
+			print("Using cached micrograph names for "+inMcgs)
+			return mcg_parsed_names, name_index, key_lengths
+		cached.close()
+	except (IOError, OSError, KeyError, ValueError):
+		pass
+
+	mcg_parsed_names = parse_star(inMcgs)
+	keys = [no_ext(name) for name in mcg_parsed_names]
+	name_index, key_lengths = build_name_index(mcg_parsed_names, keys)
+
+	# Cache the index, writing to a temporary file first so readers never see a partial one
+	try:
+		if os.path.isdir(cache_dir) == False:
+			os.makedirs(cache_dir)
+		meta = [abs_path, str(stat.st_size), str(stat.st_mtime), file_digest(abs_path)]
+		g = open(cache_file+".tmp", "wb")
+		np.savez(g, meta=np.array(meta, dtype=str), names=np.array(mcg_parsed_names, dtype=str), keys=np.array(keys, dtype=str))
+		g.close()
+		os.replace(cache_file+".tmp", cache_file)
+		evict_cache(cache_dir)
+	except (IOError, OSError):
+		print("NOTICE: Could not write the micrograph name cache in "+cache_dir+".")
+
+	return mcg_parsed_names, name_index, key_lengths
+
+
+def file_digest(inFile):
+	"""
+	Returns the sha1 hex digest of a file's contents.
+
+	"""
+	digest = hashlib.sha1()
+	g = open(inFile, "rb")
+	block = g.read(1 << 20)
+	while len(block) > 0:
+		digest.update(block)
+		block = g.read(1 << 20)
+	g.close()
+	return digest.hexdigest()
+
+
+def evict_cache(cache_dir, max_bytes=CACHE_MAX_BYTES):
+	"""
+	Deletes the least recently used cache files until the cache folder is no larger than max_bytes.
+
+	"""
+	entries = []
+	for item in listdir(cache_dir):
+		if item.endswith(".npz"):
+			stat = os.stat(join(cache_dir, item))
+			entries.append((stat.st_mtime, stat.st_size, item))
+	total = sum([entry[1] for entry in entries])
+	for entry in sorted(entries):
+		if total <= max_bytes:
+			break
+		os.remove(join(cache_dir, entry[2]))
+		total -= entry[1]
+
+
+def build_name_index(mcg_parsed_names, keys=None):
+	"""
+	Maps the extension-free name of each star file micrograph to its first position in mcg_parsed_names.  Also
+	returns the distinct key lengths, so candidate substrings of a cryosparc path can be looked up directly.  keys
+	can pass in extension-free names that were already computed.
+
+	"""
+	if keys == None:
+		keys = [no_ext(name) for name in mcg_parsed_names]
+	name_index = {}
+	for i in range(0, len(mcg_parsed_names)):
+		key = keys[i]
+		if key not in name_index:
+			name_index[key] = i
+	key_lengths = sorted(set([len(key) for key in name_index]))
+
+	return name_index, key_lengths
+
+
+def resolve_name(target, name_index, key_lengths):
+	"""
+	Returns the position of the first star file micrograph whose extension-free name is a substring of target,
+	or -1 if there is none.
+
+	"""
+	best = -1
+	for length in key_lengths:
+		for pos in range(0, len(target)-length+1):
+			i = name_index.get(target[pos:pos+length], -1)
+			if (i != -1) and ((best == -1) or (i < best)):
+				best = i
+
+	return best
+
+
+def match_micrographs(path_column, name_index, key_lengths, resolved=None, progress=True):
+	"""
+	Takes the micrograph path column of a cs file and returns the per-particle star file micrograph positions,
+	along with any cryosparc paths that could not be matched.  Each distinct path is only normalized once; passing
+	the same resolved dictionary between calls carries that across chunks of one file.
+
+	"""
+	import numpy as np
+	if resolved == None:
+		resolved = {}
+	unique_paths, inverse = np.unique(path_column, return_inverse=True)
+	unique_idx = np.empty(len(unique_paths), dtype=np.int64)
+	unmatched = []
+	for j in range(0, len(unique_paths)):
+		if ((j+1) % 1000 == 0) and (progress == True):
+			print(str(clean_large_numbers(j+1))+" / "+str(clean_large_numbers(len(unique_paths)))+" micrographs")
+		target = no_dot(decode_name(unique_paths[j]))
+		if target not in resolved:
+			resolved[target] = resolve_name(target, name_index, key_lengths)
+		unique_idx[j] = resolved[target]
+		if unique_idx[j] == -1:
+			unmatched.append(target)
+
+	return unique_idx[inverse.reshape(-1)], unmatched
+
+
+def match_micrographs_sharded(pool, procs, cs_path, path_field, begin, end, name_index, key_lengths):
+	"""
+	Matches the micrograph names of particles begin to end of a cs file on a process pool.  The range is split into
+	one contiguous shard per process; each process reads its shard from the memory-mapped file, so the particle data
+	is shared through the page cache rather than copied, and only sends back int32 micrograph positions.  Gives the
+	same result as match_micrographs.
+
+	"""
+	import numpy as np
+	shard_size = max(1, -(-(end-begin) // procs))
+	futures = [pool.submit(match_shard, cs_path, path_field, i, min(i+shard_size, end), name_index, key_lengths) for i in range(begin, end, shard_size)]
+	results = [future.result() for future in futures]
+	if len(results) == 0:
+		return np.zeros(0, dtype=np.int32), []
+	unmatched = sorted(set([target for result in results for target in result[1]]))
+
+	return np.concatenate([result[0] for result in results]), unmatched
+
+
+def match_shard(cs_path, path_field, begin, end, name_index, key_lengths):
+	"""
+	Worker for match_micrographs_sharded.
+
+	"""
+	import numpy as np
+	f = load_cs(cs_path)
+	mcg_idx, unmatched = match_micrographs(f[path_field][begin:end], name_index, key_lengths, progress=False)
+	return mcg_idx.astype(np.int32), unmatched
 
 
 def mcg_find_suffix(full_list, start_ind):
@@ -263,28 +827,103 @@ def get_constant_matrix(mcg_names):
 	return constant_container
 
 
+def sample_rows(np_array, max_rows=SAMPLE_SIZE):
+	"""
+	Returns a bounded, reproducible random sample of the rows of a cs array, in file order.
+
+	"""
+	import numpy as np
+	if len(np_array) <= max_rows:
+		return np_array[:]
+	rows = np.unique(np.random.RandomState(0).randint(0, len(np_array), max_rows))
+	return np_array[rows]
+
+
+def column_cardinality(column):
+	"""
+	Returns the number of distinct values in a cs array column.
+
+	"""
+	import numpy as np
+	return len(np.unique(column))
+
+
 def assess_variability(np_array, start_index):
-	# Check the variability in floats at positions i+2, i+3, i+4
-	# If i+2 and i+3 are variable but i+4 is not, return False
+	# Check the variability in floats at positions i+2, i+3, i+4 over a sample of the particles
+	# If i+2 is more variable than i+4, return False
 	# Else return True
-	plus2 = []
-	plus3 = []
-	plus4 = []
+	sample = sample_rows(np_array)
+	names = np_array.dtype.names
 
-	for i in range(len(np_array)):
-		plus2.append(np_array[i][start_index+2])
-		plus3.append(np_array[i][start_index+3])
-		plus4.append(np_array[i][start_index+4])
-
-	plus2setlen = len(set(plus2))
-	plus3setlen = len(set(plus3))
-	plus4setlen = len(set(plus4))
+	plus2setlen = column_cardinality(sample[names[start_index+2]])
+	plus4setlen = column_cardinality(sample[names[start_index+4]])
 
 	if plus2setlen > plus4setlen:
 		return False
 	else:
 		return True
-	
+
+
+def resolve_schema(np_array, force_no_nudge=False, profiler=None):
+	"""
+	Returns the names of the micrograph path, micrograph shape, x_frac and y_frac fields of a cs array, or None if
+	they cannot be found.  Known cryosparc field names are used directly; the positional search in infer_index is
+	only used when they are missing.
+
+	"""
+	names = np_array.dtype.names
+	for prefix in CS_FIELD_PREFIXES:
+		schema = tuple([prefix+suffix for suffix in CS_FIELD_SUFFIXES])
+		if all([field in names for field in schema]):
+			return schema
+
+	return infer_fields(np_array, force_no_nudge, profiler)
+
+
+def infer_fields(np_array, force_no_nudge=False, profiler=None):
+	"""
+	Positional fallback for resolve_schema, for cs files without the usual field names.
+
+	"""
+	with profile_phase(profiler, "infer_index", len(np_array)):
+		inferred = infer_index(np_array)
+	if inferred == None:
+		return None
+	start_index, x_index = inferred
+	names = np_array.dtype.names
+
+	# Define indeces for x_frac and y_frac by checking for overly consistent coordinates
+	# Check if x_index and x_index+1 are floats
+	if (np_array[0][x_index].dtype == "float32") and (np_array[0][x_index] <= 1.0) and (np_array[0][x_index+1].dtype == "float32") and (np_array[0][x_index+1] <= 1.0):
+		need_nudge_flag = True
+	else:
+		need_nudge_flag = False
+
+	# If all three are coordinate floats of 1 or less, look for repetition in positions +2, +3, and +4 over a sample of the particles
+	problem_indeces = []
+	if start_index == x_index:
+		if need_nudge_flag == True:
+			with profile_phase(profiler, "nudge_detection", len(np_array)):
+				sample = sample_rows(np_array)
+				for i in [2, 3, 4]:
+					if column_cardinality(sample[names[start_index+i]]) < len(sample) * 0.01:
+						problem_indeces.append(i)
+			if force_no_nudge == True:
+				print("\nWARNING: --no_nudge flag was invoked by user.\n\tThe script is forced to guess based on where they usually are.\n\tThe output coordinates may not be correct!\n\tPlease verify that your output pick positions match what you expect.\n\tProceeding...\n")
+				adj_start_index = start_index
+			elif (2 in problem_indeces) and (len(problem_indeces) == 1):
+				print("\nNOTICE: Particle coordinates may have been stored in an unexpected place in the cryosparc file provided.\n\tWe have made our best guess as to where in the file your pick coordinates are.\n\tWe're quite confident they *should* be correct, but can't guarantee it.\n\tThis probably isn't a problem, but please carefully verify that your output pick positions match what you expect.\n\tTo disable this dynamic selection and fall back to where the coordinates *usually* are, rerun\n\t\t the program with the --no_nudge flag.\n\tIf this continues to be an issue, try a different cryosparc output file.\n\tProceeding...\n")
+				adj_start_index = start_index + 1 # nudged start index to accomodate the extra cryosparc data
+			else:
+				print("\nWARNING: We could not unambiguously identify the particle coordinates in this cryosparc file.\n\tThe script is forced to guess based on where they usually are.\n\tThe output coordinates may not be correct!\n\tPlease verify that your output pick positions match what you expect.\n\tProceeding...\n")
+				adj_start_index = start_index
+		else:
+			adj_start_index = start_index
+	else:
+		adj_start_index = x_index - 2
+
+	return names[start_index], names[start_index+1], names[adj_start_index+2], names[adj_start_index+3]
+
 
 def infer_index(np_array):
 	# Default defined pattern is binary string, list of two ints >1000, float <= 1, float <=1
@@ -328,18 +967,494 @@ def infer_index(np_array):
 				pass
 
 
-def line_writer(x, y):
-	# Process x and y
-	padded_x = leftpad(x, 12)
-	padded_y = leftpad(y, 12)
-	remainder = "     0.080000            0     0.000000 \n"
-	return (padded_x + " " + padded_y + remainder)
+def convert_window(np_array, schema, name_index, key_lengths, mcg_parsed_names, transform, resolved=None, profiler=None, match_shards=None, begin=0):
+	"""
+	Matches and transforms the particles in a projected cs array and returns their coordinates grouped by
+	micrograph name.  If match_shards is given, the micrograph names of particles begin to begin+len(np_array) of
+	the cs file are matched with it instead of in this process.
+
+	"""
+	path_field, shape_field, x_field, y_field = schema
+
+	# Match star to cs entries once per distinct micrograph path, then broadcast back to the particles
+	with profile_phase(profiler, "matching", len(np_array)):
+		if match_shards != None:
+			mcg_idx, unmatched = match_shards(begin, begin+len(np_array), name_index, key_lengths)
+		else:
+			mcg_idx, unmatched = match_micrographs(np_array[path_field], name_index, key_lengths, resolved)
+
+	# Stop if the star and cs files don't have matching micrograph names
+	if len(unmatched) > 0:
+		raise ConversionError("There was no match found for the following micrograph: "+unmatched[0]+"\nThis can happen if your cryosparc and relion jobs didn't use the same input raw micrographs.\nPerhaps the .cs file and the .star file don't correspond to the same data?\nDEBUG: path_field = "+path_field)
+
+	# Transform the coordinates for all particles at once
+	with profile_phase(profiler, "transform", len(np_array)):
+		x_coords, y_coords = transform_coordinates(np_array[shape_field], np_array[x_field], np_array[y_field], transform[0], transform[1], transform[2])
+
+	# Group the particles by micrograph
+	with profile_phase(profiler, "grouping", len(np_array)):
+		groups = group_coordinates(mcg_idx, x_coords, y_coords, mcg_parsed_names)
+
+	return groups
+
+
+class CoordinateGroups(object):
+	"""
+	Particle coordinates grouped by micrograph in compressed sparse row form: the picks of micrograph names[i] are
+	x[offsets[i]:offsets[i+1]] and y[offsets[i]:offsets[i+1]], held in two contiguous int32 arrays.
+
+	"""
+	def __init__(self, names, offsets, x, y):
+		self.names = names
+		self.offsets = offsets
+		self.x = x
+		self.y = y
+
+	def __len__(self):
+		return len(self.names)
+
+	def coords(self, i):
+		"""
+		Returns views of the x and y coordinates of micrograph names[i].
+
+		"""
+		return self.x[self.offsets[i]:self.offsets[i+1]], self.y[self.offsets[i]:self.offsets[i+1]]
+
+	def as_dict(self):
+		"""
+		Returns a dictionary of micrograph name -> (x array, y array).
+
+		"""
+		return dict([(self.names[i], self.coords(i)) for i in range(0, len(self.names))])
+
+	@classmethod
+	def from_arrays(cls, names, x_arrays, y_arrays):
+		"""
+		Packs per-micrograph coordinate arrays, in the order of names, into CoordinateGroups.
+
+		"""
+		import numpy as np
+		offsets = np.zeros(len(names)+1, dtype=np.int64)
+		offsets[1:] = np.cumsum([len(x_coords) for x_coords in x_arrays])
+		if len(names) == 0:
+			return cls([], offsets, np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32))
+		return cls(list(names), offsets, np.concatenate(x_arrays).astype(np.int32), np.concatenate(y_arrays).astype(np.int32))
+
+
+def group_coordinates(mcg_idx, x_coords, y_coords, mcg_parsed_names):
+	"""
+	Groups the particle coordinates by micrograph with a single stable argsort of the micrograph indices, so the
+	particles of each micrograph stay in file order.  Micrographs are in star file order.
+
+	"""
+	import numpy as np
+	order = np.argsort(mcg_idx, kind="stable")
+	unique_idx, starts = np.unique(mcg_idx[order], return_index=True)
+	offsets = np.append(starts, len(order)).astype(np.int64)
+	names = [mcg_parsed_names[i] for i in unique_idx.tolist()]
+
+	return CoordinateGroups(names, offsets, x_coords[order].astype(np.int32), y_coords[order].astype(np.int32))
+
+
+def merge_picks(coord_sets, min_dist):
+	"""
+	Merges several CoordinateGroups, as returned by convert, into one.  Picks are taken in the order of coord_sets,
+	and a pick is dropped if it lies within min_dist pixels of a pick already kept for the same micrograph from an
+	earlier set.
+
+	"""
+	import numpy as np
+	names = []
+	merged = {}
+	for coord_set in coord_sets:
+		for i in range(0, len(coord_set)):
+			item = coord_set.names[i]
+			x_coords, y_coords = coord_set.coords(i)
+			if item not in merged:
+				names.append(item)
+				merged[item] = (x_coords, y_coords)
+				continue
+			kept_x, kept_y = merged[item]
+			new = near_picks(kept_x, kept_y, x_coords, y_coords, min_dist) == False
+			merged[item] = (np.concatenate([kept_x, x_coords[new]]), np.concatenate([kept_y, y_coords[new]]))
+
+	return CoordinateGroups.from_arrays(names, [merged[item][0] for item in names], [merged[item][1] for item in names])
+
+
+def near_picks(ref_x, ref_y, x_coords, y_coords, min_dist):
+	"""
+	Flags the picks (x_coords, y_coords) lying within min_dist pixels of any reference pick.  The reference picks
+	are bucketed into a grid of min_dist-sized cells sorted by cell, so each pick is only compared against the
+	reference picks of its own and the 8 surrounding cells, keeping the cost near-linear in the number of picks.
+
+	"""
+	import numpy as np
+	ref_x = np.asarray(ref_x, dtype=np.int64)
+	ref_y = np.asarray(ref_y, dtype=np.int64)
+	x_coords = np.asarray(x_coords, dtype=np.int64)
+	y_coords = np.asarray(y_coords, dtype=np.int64)
+	near = np.zeros(len(x_coords), dtype=bool)
+	if (len(ref_x) == 0) or (len(x_coords) == 0) or (min_dist <= 0):
+		return near
+	cell = max(float(min_dist), 1.0)
+	ref_cx = np.floor(ref_x/cell).astype(np.int64)
+	ref_cy = np.floor(ref_y/cell).astype(np.int64)
+	cx = np.floor(x_coords/cell).astype(np.int64)
+	cy = np.floor(y_coords/cell).astype(np.int64)
+
+	# Number the cells row by row, with a margin of one cell on every side for the neighbouring cells
+	min_cx = min(ref_cx.min(), cx.min())-1
+	min_cy = min(ref_cy.min(), cy.min())-1
+	width = max(ref_cy.max(), cy.max())-min_cy+2
+	ref_keys = (ref_cx-min_cx)*width+(ref_cy-min_cy)
+	order = np.argsort(ref_keys, kind="stable")
+	sorted_keys = ref_keys[order]
+
+	for dx in (-1, 0, 1):
+		for dy in (-1, 0, 1):
+			keys = (cx+dx-min_cx)*width+(cy+dy-min_cy)
+			lo = np.searchsorted(sorted_keys, keys, side="left")
+			counts = np.searchsorted(sorted_keys, keys, side="right")-lo
+			if counts.sum() == 0:
+				continue
+			# Expand every pick into one (pick, reference pick) pair per reference pick in the neighbouring cell
+			picks = np.repeat(np.arange(len(keys)), counts)
+			starts = np.repeat(lo-(np.cumsum(counts)-counts), counts)
+			refs = order[starts+np.arange(len(picks))]
+			dist2 = (x_coords[picks]-ref_x[refs])**2+(y_coords[picks]-ref_y[refs])**2
+			near[picks[dist2 < min_dist*min_dist]] = True
+
+	return near
+
+
+def transform_coordinates(shape_column, x_frac_column, y_frac_column, flipx, flipy, swapxy):
+	"""
+	Converts the fractional cryosparc particle positions to relion pixel coordinates as whole-column operations.
+	Returns integer x and y coordinate arrays.
+
+	"""
+	import numpy as np
+	h = shape_column[:, 0]
+	l = shape_column[:, 1]
+	if flipx == False:
+		x_frac = x_frac_column
+	else:
+		x_frac = 1 - x_frac_column
+	if flipy == False:
+		y_frac = y_frac_column
+	else:
+		y_frac = 1 - y_frac_column
+
+	x_coord = np.rint(l*x_frac)
+	y_coord = np.rint(h-(h*y_frac))
+	if swapxy == True: #swapxy implementation
+		x_coord, y_coord = y_coord, x_coord
+
+	return x_coord.astype(np.int64), y_coord.astype(np.int64)
+
+
+def write_star_files(groups, jobs=1, out_dir="Raw_data"):
+	"""
+	Writes one autopick star file per micrograph into out_dir, with a single buffered write per file.  The
+	micrographs are sharded over jobs threads so that file creation latency on network storage overlaps.
+
+	"""
+	run_shards(partial(write_star_shard, groups=groups, out_dir=out_dir), list(range(0, len(groups))), jobs, "star files")
+
+
+def write_star_shard(shard, groups, out_dir):
+	for i in shard:
+		x_coords, y_coords = groups.coords(i)
+		g = open(join(out_dir, no_ext(groups.names[i])+"_autopick.star"), "wb")
+		g.write(STAR_HEADER.encode()+format_star_block(x_coords, y_coords)+b"\n")
+		g.close()
+	return len(shard)
+
+
+def write_star_files_incremental(groups, jobs=1, out_dir="Raw_data"):
+	"""
+	Re-converts into out_dir using the manifest of per-micrograph coordinate hashes left there by the previous run.
+	Only micrographs whose picks changed are rewritten; unchanged star files are hard-linked from the previous
+	folder, and star files for micrographs without picks are dropped.  The new folder is assembled next to out_dir
+	and swapped in once complete (see swap_directories); files in out_dir other than autopick star files are carried
+	across.  Returns the number of star files written, kept and removed.
+
+	"""
+	recover_swap(out_dir)
+	old_manifest = read_manifest(out_dir)
+	old_stars = set()
+	if os.path.isdir(out_dir):
+		old_stars = set([name for name in listdir(out_dir) if name.endswith("_autopick.star")])
+	staging = out_dir.rstrip("/")+".staging"
+	os.mkdir(staging)
+
+	new_manifest = {}
+	run_shards(partial(update_star_shard, groups=groups, out_dir=out_dir, staging=staging, old_manifest=old_manifest, new_manifest=new_manifest), list(range(0, len(groups))), jobs, "star files")
+	g = open(join(staging, MANIFEST_NAME), "w")
+	json.dump(new_manifest, g, indent=0, sort_keys=True)
+	g.close()
+	swap_directories(staging, out_dir)
+
+	kept = len([name for name in new_manifest if old_manifest.get(name) == new_manifest[name]])
+	removed = len(old_stars.difference(new_manifest))
+	return len(new_manifest)-kept, kept, removed
+
+
+def update_star_shard(shard, groups, out_dir, staging, old_manifest, new_manifest):
+	import numpy as np
+	for i in shard:
+		name = no_ext(groups.names[i])+"_autopick.star"
+		# Hash the coordinates as int64, as earlier manifests did
+		x_coords, y_coords = [coords.astype(np.int64) for coords in groups.coords(i)]
+		digest = hashlib.sha1(x_coords.tobytes()+y_coords.tobytes()).hexdigest()
+		new_manifest[name] = digest
+		if (old_manifest.get(name) == digest) and os.path.isfile(join(out_dir, name)):
+			try:
+				os.link(join(out_dir, name), join(staging, name))
+			except OSError:
+				shutil.copyfile(join(out_dir, name), join(staging, name))
+		else:
+			g = open(join(staging, name), "wb")
+			g.write(STAR_HEADER.encode()+format_star_block(x_coords, y_coords)+b"\n")
+			g.close()
+	return len(shard)
+
+
+def read_manifest(out_dir):
+	"""
+	Returns the star file name -> coordinate hash manifest of an incremental output folder, or an empty dictionary
+	if there is none.
+
+	"""
+	try:
+		g = open(join(out_dir, MANIFEST_NAME), "r")
+		manifest = json.load(g)
+		g.close()
+	except (IOError, OSError, ValueError):
+		return {}
+	return manifest
+
+
+def swap_directories(staging, out_dir):
+	"""
+	Replaces out_dir with the completed staging folder, then moves any files other than autopick star files across
+	from the old folder and deletes it.  On Linux the two folders are exchanged in a single atomic rename, so out_dir
+	always holds a full set of star files.  Elsewhere the old folder is renamed to out_dir.old first, leaving a short
+	window without out_dir; if a run is interrupted there, recover_swap puts the folders back in order on the next
+	run.
+
+	"""
+	if os.path.isdir(out_dir) == False:
+		os.rename(staging, out_dir)
+		return
+	if exchange_paths(staging, out_dir) == True:
+		retire_directory(staging, out_dir)
+		return
+	retired = out_dir.rstrip("/")+".old"
+	os.rename(out_dir, retired)
+	os.rename(staging, out_dir)
+	retire_directory(retired, out_dir)
+
+
+def exchange_paths(first, second):
+	"""
+	Atomically exchanges two paths with renameat2(RENAME_EXCHANGE).  Returns False if the system or file system
+	does not support it.
+
+	"""
+	try:
+		import ctypes
+		import ctypes.util
+		libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+		# AT_FDCWD = -100, RENAME_EXCHANGE = 2
+		return libc.renameat2(-100, os.fsencode(first), -100, os.fsencode(second), 2) == 0
+	except (OSError, AttributeError):
+		return False
+
 
+def retire_directory(retired, out_dir):
+	"""
+	Moves any files and folders other than autopick star files and the manifest from a replaced output folder into
+	out_dir, then deletes the replaced folder.
 
-def leftpad(inStr, final_len):
-	while len(inStr) < final_len:
-		inStr = " "+inStr
-	return inStr
+	"""
+	for item in listdir(retired):
+		if item.endswith("_autopick.star") or (item == MANIFEST_NAME):
+			continue
+		if os.path.exists(join(out_dir, item)) == False:
+			os.rename(join(retired, item), join(out_dir, item))
+	shutil.rmtree(retired)
+
+
+def recover_swap(out_dir):
+	"""
+	Cleans up after an --incremental run that was interrupted while writing or swapping folders.  If out_dir is
+	missing, the completed staging folder (or else the old folder) is put back in its place; files other than star
+	files in any leftover folder are then carried into out_dir.
+
+	"""
+	staging = out_dir.rstrip("/")+".staging"
+	retired = out_dir.rstrip("/")+".old"
+	if os.path.isdir(out_dir) == False:
+		if os.path.isfile(join(staging, MANIFEST_NAME)):
+			print("NOTICE: Completing an interrupted --incremental update of "+out_dir+".")
+			os.rename(staging, out_dir)
+		elif os.path.isdir(retired):
+			print("NOTICE: Restoring "+out_dir+" after an interrupted --incremental update.")
+			os.rename(retired, out_dir)
+	for leftover in [staging, retired]:
+		if os.path.isdir(leftover):
+			if os.path.isdir(out_dir):
+				retire_directory(leftover, out_dir)
+			else:
+				shutil.rmtree(leftover)
+
+
+def write_star_archive(groups, archive_path):
+	"""
+	Streams the autopick star files straight into a tar (.tar, .tar.gz, .tgz) or zip archive, using the same
+	Raw_data/<name>_autopick.star member layout as the folder output, without creating them on disk first.
+
+	"""
+	import io
+	import tarfile
+	import zipfile
+	if archive_path.endswith(".zip"):
+		archive = zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED)
+	elif archive_path.endswith(".tar.gz") or archive_path.endswith(".tgz"):
+		archive = tarfile.open(archive_path, "w:gz")
+	else:
+		archive = tarfile.open(archive_path, "w")
+
+	done = 0
+	for i in range(0, len(groups)):
+		done = report_progress(done, 1, len(groups), "star files")
+		x_coords, y_coords = groups.coords(i)
+		member = "Raw_data/"+no_ext(groups.names[i])+"_autopick.star"
+		data = STAR_HEADER.encode()+format_star_block(x_coords, y_coords)+b"\n"
+		if isinstance(archive, zipfile.ZipFile):
+			archive.writestr(member, data)
+		else:
+			info = tarfile.TarInfo(member)
+			info.size = len(data)
+			info.mtime = time.time()
+			info.mode = 0o644
+			archive.addfile(info, io.BytesIO(data))
+	archive.close()
+
+
+def append_star_files(groups, started, jobs=1, out_dir="Raw_data"):
+	"""
+	Streaming counterpart of write_star_files.  Micrographs seen for the first time get a new star file with a
+	header and are recorded in started; later chunks append to the existing file.
+
+	"""
+	run_shards(partial(append_star_shard, groups=groups, started=started, out_dir=out_dir), list(range(0, len(groups))), jobs)
+	started.update(groups.names)
+
+
+def append_star_shard(shard, groups, started, out_dir):
+	for i in shard:
+		item = groups.names[i]
+		x_coords, y_coords = groups.coords(i)
+		block = format_star_block(x_coords, y_coords)
+		if item in started:
+			g = open(join(out_dir, no_ext(item)+"_autopick.star"), "ab")
+			g.write(block)
+		else:
+			g = open(join(out_dir, no_ext(item)+"_autopick.star"), "wb")
+			g.write(STAR_HEADER.encode()+block)
+		g.close()
+	return len(shard)
+
+
+def finish_star_files(started, jobs=1, out_dir="Raw_data"):
+	"""
+	Closes out the star files written by append_star_files.
+
+	"""
+	run_shards(partial(finish_star_shard, out_dir=out_dir), sorted(started), jobs)
+
+
+def finish_star_shard(shard, out_dir):
+	for item in shard:
+		g = open(join(out_dir, no_ext(item)+"_autopick.star"), "ab")
+		g.write(b"\n")
+		g.close()
+	return len(shard)
+
+
+def run_shards(func, items, jobs=1, label=None):
+	"""
+	Calls func on consecutive shards of items, on a pool of jobs threads when jobs > 1.  func returns the number of
+	items it handled; if a label is given, the combined progress is printed every PROGRESS_STEP items.
+
+	"""
+	from concurrent.futures import ThreadPoolExecutor, as_completed
+	shard_size = max(1, min(PROGRESS_STEP, -(-len(items) // (max(jobs, 1)*4))))
+	shards = [items[i:i+shard_size] for i in range(0, len(items), shard_size)]
+
+	done = 0
+	if jobs > 1:
+		with ThreadPoolExecutor(max_workers=jobs) as pool:
+			futures = [pool.submit(func, shard) for shard in shards]
+			for future in as_completed(futures):
+				done = report_progress(done, future.result(), len(items), label)
+	else:
+		for shard in shards:
+			done = report_progress(done, func(shard), len(items), label)
+
+
+def report_progress(done, count, total, label):
+	"""
+	Adds count to done and prints the progress if it crossed a multiple of PROGRESS_STEP.  Returns the new total.
+
+	"""
+	if (label != None) and (((done+count) // PROGRESS_STEP > done // PROGRESS_STEP) or (done+count == total)):
+		print(clean_large_numbers(done+count)+" / "+clean_large_numbers(total)+" "+label)
+	return done+count
+
+
+def format_star_block(x_coords, y_coords):
+	"""
+	Formats the coordinate rows of one autopick star file as bytes.  The digits of every coordinate are written into
+	a preallocated fixed-width buffer at once, giving the same rows as STAR_ROW.
+
+	"""
+	import numpy as np
+	x_coords = np.asarray(x_coords, dtype=np.int64)
+	y_coords = np.asarray(y_coords, dtype=np.int64)
+	if len(x_coords) == 0:
+		return b""
+
+	# Coordinates that don't fit the fixed-width columns are formatted one row at a time instead
+	if (min(x_coords.min(), y_coords.min()) < 0) or (max(x_coords.max(), y_coords.max()) >= 10**COORD_DIGITS):
+		return "".join([STAR_ROW % (x, y) for x, y in zip(x_coords.tolist(), y_coords.tolist())]).encode()
+
+	template = (STAR_ROW % (0, 0)).encode()
+	buf = np.empty((len(x_coords), len(template)), dtype=np.uint8)
+	buf[:] = np.frombuffer(template, dtype=np.uint8)
+	for start, coords in [(0, x_coords), (COORD_DIGITS+3, y_coords)]:
+		remaining = coords.copy()
+		for k in range(0, COORD_DIGITS):
+			digits = remaining % 10
+			mask = (remaining > 0) | (k == 0)
+			buf[mask, start+COORD_DIGITS-1-k] = ord("0") + digits[mask]
+			remaining //= 10
+			if not remaining.any():
+				break
+
+	return buf.tobytes()
+
+
+def decode_name(inName):
+	"""
+	Returns a cryosparc path entry as a string, whether the cs file stored it as bytes or as a python string.
+
+	"""
+	if isinstance(inName, bytes):
+		return inName.decode("utf-8")
+	return str(inName)
 
 
 def no_dot(inStr):
@@ -399,7 +1514,18 @@ def clean_large_numbers(inInt):
 
 
 if __name__ == "__main__":
+	args = build_parser().parse_args()
 	if (args.cs == None) or (args.star == None):
 		print("Check usage: python cs_to_stars.py --cs /path/to/your/cryosparc/file.cs --star /path/to/your/micrographs_ctf.star\nUse python cs_to_stars.py --help for all options.")
-	else:
-		main(args)
+		sys.exit(0)
+	try:
+		if args.cprofile != None:
+			import cProfile
+			cProfile.run("main(args)", args.cprofile)
+			print("cProfile statistics written to "+args.cprofile)
+		else:
+			main(args)
+	except ConversionError as e:
+		print("\nERROR: "+str(e))
+		print("Exiting...")
+		sys.exit(1)
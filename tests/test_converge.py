@@ -0,0 +1,238 @@
+"""
+
+Tests for converge.py
+
+"""
+
+import numpy as np
+import pytest
+
+import converge
+
+
+def write_star(path, text):
+	g = open(path, "w")
+	g.write(text)
+	g.close()
+	return str(path)
+
+
+OPTICS = """
+# version 30001
+
+data_optics
+
+loop_ 
+_rlnOpticsGroupName #1 
+_rlnOpticsGroup #2 
+_rlnImageName #3 
+_rlnImageSize #4 
+opticsGroup1            1 optics_reference.mrcs          256 
+ 
+"""
+
+
+def test_parse_star_skips_image_name_in_optics_block(tmp_path):
+	star = write_star(tmp_path / "run_it001_data.star", OPTICS+"""
+# version 30001
+
+data_particles
+
+loop_ 
+_rlnCoordinateX #1 
+_rlnClassNumber #2 
+_rlnImageName #3 
+_rlnOpticsGroup #4 
+  100.000000     3 000001@Extract/job012/Movies/mic_001.mrcs            1 
+  200.000000    12 000002@Extract/job012/Movies/mic_001.mrcs            1 
+  300.000000     1 000001@Extract/job012/Movies/mic_002.mrcs            1 
+ 
+""")
+	names, classes = converge.parse_star(star)
+	assert names == [b"000001@Extract/job012/Movies/mic_001.mrcs", b"000002@Extract/job012/Movies/mic_001.mrcs", b"000001@Extract/job012/Movies/mic_002.mrcs"]
+	assert classes.dtype == np.int16
+	assert classes.tolist() == [3, 12, 1]
+
+
+def test_parse_star_prefers_particles_block(tmp_path):
+	# A loop with both columns before data_particles doesn't win over data_particles
+	star = write_star(tmp_path / "run_it001_data.star", """
+data_other
+
+loop_ 
+_rlnImageName #1 
+_rlnClassNumber #2 
+other@stack.mrcs 7 
+
+data_particles
+
+loop_ 
+_rlnImageName #1 
+_rlnClassNumber #2 
+1@stack.mrcs 2 
+2@stack.mrcs 4 
+""")
+	names, classes = converge.parse_star(star)
+	assert names == [b"1@stack.mrcs", b"2@stack.mrcs"]
+	assert classes.tolist() == [2, 4]
+
+
+def test_parse_star_without_column_numbers(tmp_path):
+	# relion 3.0 style: no data_particles block and no #N after the labels
+	star = write_star(tmp_path / "run_it001_data.star", """
+data_
+
+loop_
+_rlnCoordinateX
+_rlnImageName
+_rlnMicrographName
+_rlnClassNumber
+100.0 1@a.mrcs mic_1.mrc 5
+200.0 2@a.mrcs mic_1.mrc 6
+
+""")
+	names, classes = converge.parse_star(star)
+	assert names == [b"1@a.mrcs", b"2@a.mrcs"]
+	assert classes.tolist() == [5, 6]
+
+
+def test_parse_star_uses_column_numbers(tmp_path):
+	# Column numbers take precedence over the order of the labels
+	star = write_star(tmp_path / "run_it001_data.star", """
+data_particles
+
+loop_
+_rlnClassNumber #3
+_rlnImageName #1
+_rlnCoordinateX #2
+1@a.mrcs 100.0 9
+2@a.mrcs 200.0 8
+""")
+	names, classes = converge.parse_star(star)
+	assert names == [b"1@a.mrcs", b"2@a.mrcs"]
+	assert classes.tolist() == [9, 8]
+
+
+def test_parse_star_without_classes(tmp_path):
+	star = write_star(tmp_path / "run_it001_data.star", OPTICS)
+	with pytest.raises(ValueError):
+		converge.parse_star(star)
+
+
+def make_iterations():
+	"""
+	Returns the particle names and classes of four iterations, with particles reordered, added and dropped.
+
+	"""
+	rng = np.random.RandomState(0)
+	names = [("%06d@stack.mrcs" % i).encode() for i in range(0, 300)]
+	iterations = []
+	present = list(range(0, 200))
+	for it in range(0, 4):
+		if it == 2:
+			# Particles 150-199 drop out and 200-299 are added
+			present = list(range(0, 150))+list(range(200, 300))
+		order = rng.permutation(present) if it == 3 else present
+		iterations.append(([names[i] for i in order], rng.randint(1, 9, len(order)).astype(np.int16)))
+	return iterations
+
+
+def test_class_history_interns_particles():
+	iterations = make_iterations()
+	history = converge.ClassHistory(1)
+	for names, classes in iterations:
+		history.add_iteration(names, classes)
+	assert history.iterations == 4
+	assert history.iteration_numbers == [1, 2, 3, 4]
+	assert len(history.ids) == 300
+	for it in range(0, 4):
+		column = history.column(it+1)
+		by_name = dict(zip(iterations[it][0], iterations[it][1].tolist()))
+		for name in history.ids:
+			assert column[history.ids[name]] == by_name.get(name, 0)
+		assert history.populations[it].tolist() == np.bincount(iterations[it][1], minlength=1).tolist()
+
+	counts = converge.class_counter(history)
+	first_seen = []
+	for names, classes in iterations:
+		for item in classes.tolist():
+			if str(item) not in first_seen:
+				first_seen.append(str(item))
+	assert list(counts.keys()) == first_seen
+	assert counts["3"] == [int((classes == 3).sum()) for names, classes in iterations]
+
+
+def read_csv(path):
+	g = open(str(path), "r")
+	rows = [line.split(",") for line in g.read().splitlines()[1:]]
+	g.close()
+	return rows
+
+
+def test_transitions_match_brute_force(tmp_path):
+	iterations = make_iterations()
+	history = converge.ClassHistory(1)
+	previous = {}
+	for it in range(0, len(iterations)):
+		names, classes = iterations[it]
+		history.add_iteration(names, classes)
+		current = dict(zip(names, classes.tolist()))
+		if it == 0:
+			previous = current
+			continue
+
+		# Particles added or dropped between iterations count as changes, from or to class 0
+		changed = len([name for name in set(previous).union(current) if previous.get(name, 0) != current.get(name, 0)])
+		transitions = history.transitions()
+		assert int(transitions.sum()-transitions.trace()) == changed
+		for name in set(previous).union(current):
+			assert transitions[previous.get(name, 0), current.get(name, 0)] > 0
+		assert transitions.sum() == len(history.ids)
+		previous = current
+
+	# The logs list every class with its flows, and each pair of classes that exchanged particles
+	converge.start_transitions(str(tmp_path))
+	converge.write_transitions(transitions, 4, str(tmp_path))
+	rows = read_csv(tmp_path / "converge_classes.csv")
+	for row in rows:
+		item = int(row[1])
+		assert int(row[2]) == transitions[item, :].sum()
+		assert int(row[3]) == transitions[:, item].sum()
+		assert int(row[4]) == transitions[item, item]
+		assert int(row[5]) == transitions[:, item].sum()-transitions[item, item]
+		assert int(row[6]) == transitions[item, :].sum()-transitions[item, item]
+	rows = read_csv(tmp_path / "converge_transitions.csv")
+	assert sum([int(row[3]) for row in rows]) == int(transitions.sum()-transitions.trace())
+
+
+def test_class_history_save_load_round_trip(tmp_path):
+	iterations = make_iterations()
+	history = converge.ClassHistory(4)
+	checkpoint = str(tmp_path / "converge_checkpoint")
+	for it in range(0, 3):
+		history.add_iteration(iterations[it][0], iterations[it][1], 2*it+1)
+		star = write_star(tmp_path / ("run_it%03d_data.star" % (2*it+1)), "iteration "+str(it))
+		history.save(checkpoint, star)
+
+	loaded, last_star = converge.ClassHistory.load(checkpoint, 4)
+	assert last_star == converge.star_signature(star)
+	assert loaded.iterations == 3
+	assert loaded.iteration_numbers == [1, 3, 5]
+	assert loaded.ids == history.ids
+	assert loaded.class_order == history.class_order
+	for it in range(1, 4):
+		assert loaded.column(it).tolist() == history.column(it).tolist()
+	assert [counts.tolist() for counts in loaded.populations] == [counts.tolist() for counts in history.populations]
+
+	# Both carry on identically after the checkpoint
+	history.add_iteration(iterations[3][0], iterations[3][1], 7)
+	loaded.add_iteration(iterations[3][0], iterations[3][1], 7)
+	assert loaded.column(4).tolist() == history.column(4).tolist()
+	assert (loaded.transitions() == history.transitions()).all()
+	assert converge.class_counter(loaded) == converge.class_counter(history)
+
+	# A checkpoint is not resumed once its last star file has changed
+	assert converge.resume_history(checkpoint, 4, str(tmp_path)) != None
+	write_star(tmp_path / "run_it005_data.star", "rewritten by another run")
+	assert converge.resume_history(checkpoint, 4, str(tmp_path)) == None
+	assert converge.ClassHistory.load(str(tmp_path / "missing"), 4) == (None, None)
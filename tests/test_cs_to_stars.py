@@ -0,0 +1,146 @@
+"""
+
+Tests for cs_to_stars.py
+
+"""
+
+import os
+import shutil
+from os.path import isdir, isfile, join
+
+import numpy as np
+import pytest
+
+import cs_to_stars
+
+
+def make_groups(picks):
+	names = list(picks.keys())
+	return cs_to_stars.CoordinateGroups.from_arrays(names, [np.array(picks[name][0]) for name in names], [np.array(picks[name][1]) for name in names])
+
+
+def write_file(path, text):
+	g = open(path, "w")
+	g.write(text)
+	g.close()
+
+
+def read_file(path):
+	g = open(path, "r")
+	text = g.read()
+	g.close()
+	return text
+
+
+@pytest.mark.parametrize("x_coords, y_coords", [
+	([0], [0]),
+	([1, 9, 10, 99, 100, 4095, 5759], [5759, 4095, 100, 99, 10, 9, 1]),
+	([10**10-1, 123456789], [0, 987654321]),
+	# Values that overflow the fixed-width columns, or are negative, take the row-by-row path
+	([10**10, 5], [7, 10**12]),
+	([-1, 15], [3, -1234]),
+])
+def test_format_star_block_matches_star_row(x_coords, y_coords):
+	expected = "".join([cs_to_stars.STAR_ROW % (x, y) for x, y in zip(x_coords, y_coords)]).encode()
+	assert cs_to_stars.format_star_block(np.array(x_coords), np.array(y_coords)) == expected
+
+
+def test_format_star_block_random():
+	rng = np.random.RandomState(0)
+	x_coords = rng.randint(0, 10**rng.randint(1, 11, 1000))
+	y_coords = rng.randint(0, 10**rng.randint(1, 11, 1000))
+	expected = "".join([cs_to_stars.STAR_ROW % (x, y) for x, y in zip(x_coords.tolist(), y_coords.tolist())]).encode()
+	assert cs_to_stars.format_star_block(x_coords, y_coords) == expected
+	assert cs_to_stars.format_star_block(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32)) == b""
+
+
+def brute_force_near(ref_x, ref_y, x_coords, y_coords, min_dist):
+	near = np.zeros(len(x_coords), dtype=bool)
+	for i in range(0, len(x_coords)):
+		for j in range(0, len(ref_x)):
+			if (int(x_coords[i])-int(ref_x[j]))**2+(int(y_coords[i])-int(ref_y[j]))**2 < min_dist*min_dist:
+				near[i] = True
+	return near
+
+
+@pytest.mark.parametrize("min_dist", [1, 7, 25, 60, 500])
+def test_near_picks_matches_brute_force(min_dist):
+	rng = np.random.RandomState(min_dist)
+	ref_x = rng.randint(0, 1000, 300)
+	ref_y = rng.randint(0, 800, 300)
+	x_coords = np.concatenate([rng.randint(0, 1000, 300), ref_x[0:20]+min_dist-1, ref_x[20:40]+min_dist])
+	y_coords = np.concatenate([rng.randint(0, 800, 300), ref_y[0:20], ref_y[20:40]])
+	near = cs_to_stars.near_picks(ref_x, ref_y, x_coords, y_coords, min_dist)
+	assert (near == brute_force_near(ref_x, ref_y, x_coords, y_coords, min_dist)).all()
+
+
+def test_near_picks_empty():
+	assert len(cs_to_stars.near_picks([], [], [1, 2], [3, 4], 10)) == 2
+	assert cs_to_stars.near_picks([], [], [1, 2], [3, 4], 10).any() == False
+	assert len(cs_to_stars.near_picks([1], [2], [], [], 10)) == 0
+
+
+def test_merge_picks_drops_duplicates():
+	first = make_groups({"a.mrc": ([100, 500], [100, 500])})
+	second = make_groups({"a.mrc": ([105, 900], [100, 900]), "b.mrc": ([1], [2])})
+	merged = cs_to_stars.merge_picks([first, second], 10)
+	assert merged.names == ["a.mrc", "b.mrc"]
+	assert merged.coords(0)[0].tolist() == [100, 500, 900]
+	assert merged.coords(1)[1].tolist() == [2]
+
+
+@pytest.mark.parametrize("atomic", [True, False])
+def test_incremental_keeps_foreign_files(tmp_path, monkeypatch, atomic):
+	if atomic == False:
+		monkeypatch.setattr(cs_to_stars, "exchange_paths", lambda first, second: False)
+	out_dir = str(tmp_path / "keep")
+	os.makedirs(join(out_dir, "sub"))
+	write_file(join(out_dir, "notes.txt"), "notes")
+	write_file(join(out_dir, "sub", "y"), "y")
+	write_file(join(out_dir, "stale_autopick.star"), "stale")
+
+	# A folder without a manifest is only replaced after confirmation
+	with pytest.raises(cs_to_stars.OutputExistsError):
+		cs_to_stars.prepare_output(out_dir, incremental=True)
+	cs_to_stars.prepare_output(out_dir, incremental=True, overwrite=True)
+	written, kept, removed = cs_to_stars.write_star_files_incremental(make_groups({"a.mrc": ([10, 20], [30, 40]), "b.mrc": ([50], [60])}), 1, out_dir)
+	assert (written, kept, removed) == (2, 0, 1)
+	assert sorted(os.listdir(out_dir)) == sorted([cs_to_stars.MANIFEST_NAME, "a_autopick.star", "b_autopick.star", "notes.txt", "sub"])
+	assert read_file(join(out_dir, "notes.txt")) == "notes"
+	assert read_file(join(out_dir, "sub", "y")) == "y"
+	assert read_file(join(out_dir, "a_autopick.star")) == cs_to_stars.STAR_HEADER+cs_to_stars.STAR_ROW % (10, 30)+cs_to_stars.STAR_ROW % (20, 40)+"\n"
+
+	# With a manifest, only changed micrographs are rewritten and no confirmation is needed
+	cs_to_stars.prepare_output(out_dir, incremental=True)
+	written, kept, removed = cs_to_stars.write_star_files_incremental(make_groups({"a.mrc": ([10, 20], [30, 40]), "c.mrc": ([70], [80])}), 1, out_dir)
+	assert (written, kept, removed) == (1, 1, 1)
+	assert isfile(join(out_dir, "b_autopick.star")) == False
+	assert isfile(join(out_dir, "c_autopick.star"))
+	assert read_file(join(out_dir, "sub", "y")) == "y"
+	assert isdir(out_dir+".staging") == False
+	assert isdir(out_dir+".old") == False
+
+
+def test_incremental_recovers_interrupted_swap(tmp_path):
+	out_dir = str(tmp_path / "Raw_data")
+	groups = make_groups({"a.mrc": ([10], [30])})
+	cs_to_stars.write_star_files_incremental(groups, 1, out_dir)
+	write_file(join(out_dir, "notes.txt"), "notes")
+
+	# Interrupted between renaming the old folder away and renaming the staging folder into place
+	os.rename(out_dir, out_dir+".old")
+	shutil.copytree(out_dir+".old", out_dir+".staging")
+	cs_to_stars.recover_swap(out_dir)
+	assert isfile(join(out_dir, cs_to_stars.MANIFEST_NAME))
+	assert read_file(join(out_dir, "notes.txt")) == "notes"
+	assert isdir(out_dir+".old") == False
+
+	# Interrupted before the staging folder was complete
+	os.rename(out_dir, out_dir+".old")
+	os.mkdir(out_dir+".staging")
+	write_file(join(out_dir+".staging", "a_autopick.star"), "partial")
+	cs_to_stars.recover_swap(out_dir)
+	assert isfile(join(out_dir, cs_to_stars.MANIFEST_NAME))
+	assert read_file(join(out_dir, "notes.txt")) == "notes"
+	assert isdir(out_dir+".staging") == False
+	assert cs_to_stars.write_star_files_incremental(groups, 1, out_dir) == (0, 1, 0)